@@ -0,0 +1,266 @@
+"""Throughput and latency benchmarks for the pchat client pipeline.
+
+Everything runs locally: the parser and dispatcher are fed generated traffic,
+and the end-to-end and memory benchmarks connect AsyncClient to the in-process
+FakeInit6Server. The I/O benchmarks repeat a chat flood once per read backend
+and event loop. Results are printed and can also be written as JSON.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+import fake_server
+from capture import read_capture
+from client import AsyncClient
+from framer import FrameParser
+from message_handler import MessageHandler
+from transport import BACKENDS, IOSettings, ReadProtocol
+
+
+def percentiles(samples, points=(50, 90, 99, 99.9)):
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    return {f"p{p:g}": ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+def mixed_lines(users, chat, storm_cycles):
+    lines = fake_server.join_burst_lines("bench", users, operators=users // 20)
+    lines += fake_server.storm_lines(users // 4, storm_cycles)
+    lines += fake_server.chat_lines(chat)
+    return lines
+
+
+async def noop_pong(ping_id):
+    pass
+
+
+def new_handler():
+    handler = MessageHandler(send_pong=noop_pong, log_callback=lambda msg: None)
+    handler.presence.min_window = handler.presence.max_window = 0
+    return handler
+
+
+def bench_parse(data, read_size=4096):
+    """Frames and bytes per second through FrameParser.feed."""
+    parser = FrameParser()
+    start = time.perf_counter()
+    frames = 0
+    for offset in range(0, len(data), read_size):
+        frames += len(parser.feed(data[offset:offset + read_size]))
+    elapsed = time.perf_counter() - start
+    return {
+        "bytes": len(data),
+        "frames": frames,
+        "seconds": elapsed,
+        "frames_per_sec": frames / elapsed,
+        "mb_per_sec": len(data) / elapsed / 1e6,
+    }
+
+
+async def bench_dispatch(data):
+    """Per-frame latency of MessageHandler.handle_message, in microseconds."""
+    handler = new_handler()
+    frames = FrameParser().feed(data)
+    samples = []
+    clock = time.perf_counter_ns
+    for parts in frames:
+        start = clock()
+        await handler.handle_message(parts)
+        samples.append((clock() - start) / 1000)
+    if handler.batch_task is not None:
+        await handler.batch_task
+    result = {"frames": len(samples), "mean_us": sum(samples) / len(samples)}
+    result.update({f"{k}_us": v for k, v in percentiles(samples).items()})
+    return result
+
+
+async def bench_roster(users):
+    """Cost of applying a channel's worth of IN, UPDATE and LEAVE messages."""
+    handler = new_handler()
+    result = {"users": users}
+    phases = (
+        ("in", [fake_server.user_in(f"user{i}").split(" ") for i in range(users)]),
+        ("update", [fake_server.user_update(f"user{i}", flags="18" if i % 10 == 0 else "0010").split(" ") for i in range(users)]),
+        ("leave", [fake_server.user_leave(f"user{i}").split(" ") for i in range(users)]),
+    )
+    for phase, messages in phases:
+        start = time.perf_counter()
+        for parts in messages:
+            await handler.queue_user_message(parts)
+        await handler.batch_task
+        elapsed = time.perf_counter() - start
+        result[f"{phase}_ms"] = elapsed * 1000
+        result[f"{phase}_us_per_user"] = elapsed * 1e6 / users
+    return result
+
+
+async def wait_for(predicate, timeout, interval=0.01):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("benchmark condition not reached")
+        await asyncio.sleep(interval)
+
+
+async def stop_clients(clients, tasks, server):
+    for client in clients:
+        client.stop()
+    await server.stop()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def bench_end_to_end(users, chat):
+    """Wall time for a client to receive and dispatch a join burst plus chat flood."""
+    server = fake_server.FakeInit6Server(scenario=fake_server.burst_scenario(users, chat))
+    port = await server.start()
+    client = AsyncClient("127.0.0.1", port, "bench", "bench", "bench", None, asyncio.get_running_loop())
+    # Welcome, channel join and own USER IN, then the scenario's join, topic, users, own USER IN and chat
+    expected = 4 + users + 3 + chat
+    framer = client.message_handler.framer
+    start = time.perf_counter()
+    task = asyncio.create_task(client.connect())
+    await wait_for(lambda: framer.frames >= expected, timeout=120)
+    elapsed = time.perf_counter() - start
+    await stop_clients([client], [task], server)
+    return {"frames": framer.frames, "seconds": elapsed, "frames_per_sec": framer.frames / elapsed}
+
+
+async def bench_memory(sessions, users):
+    """Traced Python memory per connected session holding a roster of users."""
+    server = fake_server.FakeInit6Server(scenario=fake_server.burst_scenario(users))
+    port = await server.start()
+    loop = asyncio.get_running_loop()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    clients = [AsyncClient("127.0.0.1", port, f"bench{i}", "bench", "bench", None, loop) for i in range(sessions)]
+    tasks = [asyncio.create_task(client.connect()) for client in clients]
+    # Own user plus the scenario's users
+    await wait_for(lambda: all(len(c.message_handler.roster) >= users + 1 for c in clients), timeout=120)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    grown = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    await stop_clients(clients, tasks, server)
+    return {"sessions": sessions, "users": users, "bytes_per_session": grown / sessions}
+
+
+@contextlib.contextmanager
+def count_receives():
+    """Count data_received calls on client connections; each is one recv() that returned data."""
+    counts = {"receives": 0}
+    originals = asyncio.StreamReaderProtocol.data_received, ReadProtocol.data_received
+
+    def streams_received(self, data):
+        # Server-side protocols have a connected callback; only count the client's reads
+        if self._client_connected_cb is None:
+            counts["receives"] += 1
+        return originals[0](self, data)
+
+    def protocol_received(self, data):
+        counts["receives"] += 1
+        return originals[1](self, data)
+
+    asyncio.StreamReaderProtocol.data_received = streams_received
+    ReadProtocol.data_received = protocol_received
+    try:
+        yield counts
+    finally:
+        asyncio.StreamReaderProtocol.data_received, ReadProtocol.data_received = originals
+
+
+async def bench_io(backend, messages):
+    """Throughput and receive calls for one read backend draining a chat flood."""
+    server = fake_server.FakeInit6Server(scenario=fake_server.flood_scenario(messages))
+    port = await server.start()
+    with count_receives() as counts:
+        client = AsyncClient("127.0.0.1", port, "bench", "bench", "bench", None, asyncio.get_running_loop(),
+                             io_settings=IOSettings(backend=backend))
+        # Welcome, channel join and own USER IN, then the flood
+        expected = 4 + messages
+        framer = client.message_handler.framer
+        reads = client.reads.value
+        received = client.bytes_received.value
+        start = time.perf_counter()
+        task = asyncio.create_task(client.connect())
+        await wait_for(lambda: framer.frames >= expected, timeout=120, interval=0.001)
+        elapsed = time.perf_counter() - start
+        await stop_clients([client], [task], server)
+    received = client.bytes_received.value - received
+    return {
+        "frames_per_sec": framer.frames / elapsed,
+        "mb_per_sec": received / elapsed / 1e6,
+        "recv_calls": counts["receives"],
+        "reads": client.reads.value - reads,
+        "bytes_per_recv": received / max(counts["receives"], 1),
+    }
+
+
+def io_loops():
+    """Event loop factories to compare: the stock loop, plus uvloop when it is installed."""
+    loops = {"asyncio": asyncio.new_event_loop}
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        loops["uvloop"] = uvloop.new_event_loop
+    return loops
+
+
+def run_io(args):
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for loop_name, factory in io_loops().items():
+            for backend in BACKENDS:
+                with asyncio.Runner(loop_factory=factory) as runner:
+                    results[f"io_{loop_name}_{backend}"] = runner.run(bench_io(backend, args.io_messages))
+    return results
+
+
+def report(name, result):
+    fields = "  ".join(f"{key}={value:,.2f}" if isinstance(value, float) else f"{key}={value:,}" for key, value in result.items())
+    print(f"{name:<24} {fields}")
+
+
+async def run(args):
+    if args.capture:
+        data = b"".join(chunk for _, chunk in read_capture(args.capture))
+    else:
+        data = fake_server.encode(mixed_lines(args.users, args.chat, args.storm_cycles))
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results["parse"] = bench_parse(data, args.read_size)
+        results["dispatch"] = await bench_dispatch(data)
+        results["roster"] = await bench_roster(args.users)
+        results["end_to_end"] = await bench_end_to_end(args.users, args.chat)
+        results["memory"] = await bench_memory(args.sessions, args.session_users)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000, help="channel size for join bursts")
+    parser.add_argument("--chat", type=int, default=20000, help="chat lines in the flood")
+    parser.add_argument("--storm-cycles", type=int, default=10, help="join/leave waves")
+    parser.add_argument("--read-size", type=int, default=4096, help="bytes per simulated socket read")
+    parser.add_argument("--sessions", type=int, default=20, help="clients for the memory benchmark")
+    parser.add_argument("--session-users", type=int, default=200, help="channel size per memory-benchmark client")
+    parser.add_argument("--io-messages", type=int, default=200000, help="chat lines per I/O backend run")
+    parser.add_argument("--capture", metavar="PATH", help="use a recorded capture as the parse/dispatch corpus")
+    parser.add_argument("--json", metavar="PATH", help="also write results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    results.update(run_io(args))
+    for name, result in results.items():
+        report(name, result)
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Capture and replay of the raw inbound Init6 byte stream.
+
+A capture file is the MAGIC header followed by records of
+(wall-clock timestamp in ns, length) packed as RECORD, each followed by the
+bytes of one socket read. Files are only ever appended to, so one file can
+hold several sessions.
+"""
+import argparse
+import asyncio
+import struct
+import time
+
+MAGIC = b"PCHATCAP\x01"
+RECORD = struct.Struct("<QI")
+
+
+class CaptureWriter:
+    """Appends timestamped socket reads to a capture file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.records = 0
+
+    def write(self, data):
+        self.file.write(RECORD.pack(time.time_ns(), len(data)))
+        self.file.write(data)
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """Yield (timestamp_ns, data) for every record in a capture file."""
+    with open(path, "rb") as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a pchat capture file")
+        while True:
+            header = capture.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, length = RECORD.unpack(header)
+            data = capture.read(length)
+            if len(data) < length:
+                # Truncated final record, e.g. the process was killed mid-write
+                return
+            yield timestamp, data
+
+
+async def replay(path, handler, realtime=False, speed=1.0):
+    """Feed a capture into handler.process_buffer without any network.
+
+    With realtime the original gaps between reads are reproduced, scaled by
+    speed; otherwise records are fed as fast as possible.
+    """
+    if speed <= 0:
+        raise ValueError("speed must be positive")
+    records = 0
+    size = 0
+    first = None
+    start = time.monotonic()
+    for timestamp, data in read_capture(path):
+        if realtime:
+            if first is None:
+                first = timestamp
+            delay = (timestamp - first) / 1e9 / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await handler.process_buffer(data)
+        records += 1
+        size += len(data)
+    if handler.batch_task is not None:
+        await handler.batch_task
+    elapsed = time.monotonic() - start
+    return {"records": records, "bytes": size, "frames": handler.framer.frames, "seconds": elapsed}
+
+
+def main():
+    from message_handler import MessageHandler
+
+    parser = argparse.ArgumentParser(description="Replay a pchat capture file")
+    parser.add_argument("path", help="capture file to replay")
+    parser.add_argument("--realtime", action="store_true", help="reproduce the original timing")
+    parser.add_argument("--speed", type=float, default=1.0, help="timing multiplier with --realtime")
+    parser.add_argument("--profile", action="store_true", help="run the replay under cProfile")
+    parser.add_argument("--show", action="store_true", help="print log output instead of discarding it")
+    args = parser.parse_args()
+
+    async def noop_pong(ping_id):
+        pass
+
+    log = print if args.show else (lambda msg: None)
+    handler = MessageHandler(send_pong=noop_pong, log_callback=log)
+    coroutine = replay(args.path, handler, realtime=args.realtime, speed=args.speed)
+
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        result = profiler.runcall(asyncio.run, coroutine)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    else:
+        result = asyncio.run(coroutine)
+    print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+from roster import Roster
+
+
+class ChannelState:
+    """Everything pchat keeps about one channel: its name and roster.
+
+    A session is only in one channel at a time, but the state of channels it
+    has left recently is kept, so going back to one resyncs its roster
+    instead of rebuilding it.
+    """
+
+    __slots__ = ("name", "roster")
+
+    def __init__(self, name):
+        self.name = name
+        self.roster = Roster()
+
+    def __repr__(self):
+        return f"ChannelState({self.name!r}, users={len(self.roster)})"
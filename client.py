@@ -1,10 +1,28 @@
 import asyncio
-import re
-import traceback
+import random
+import time
 from message_handler import MessageHandler
+from capture import CaptureWriter
+from log_setup import get_logger
+from metrics import registry
+from outbound import OutboundScheduler, PRIORITY_CONTROL
+from overload import OverloadGuard
+from queries import QueryEngine
+from transport import IOSettings, open_connection
+from triggers import TriggerEngine
+
+logger = get_logger("client")
+
+# Connection states
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+CONNECTED = "connected"
+BACKOFF = "backoff"
+STOPPED = "stopped"
 
 class AsyncClient:
-    def __init__(self, host, port, uname, upass, uhome, log_callback, loop):
+    def __init__(self, host, port, uname, upass, uhome, log_callback, loop, capture_path=None, history=None, triggers=None,
+                 plugins=(), io_settings=None, overload_settings=None):
         self.host = host
         self.port = port
         self.uname = uname
@@ -16,101 +34,229 @@ class AsyncClient:
         self.reader = None
         self.writer = None
         self.running = False
-        self.delay = 5
+        self.state = DISCONNECTED
         self.timeout = 5
+        self.reconnects = 0
+        # Reconnect backoff: a quick first retry, then doubling from delay up to max_delay
+        self.first_delay = 0.5
+        self.delay = 2
+        self.max_delay = 60
+        self.stable_after = 30  # a connection that lasted this long resets the backoff
+        self.resume_window = 60  # outages shorter than this keep the roster and channel
+        self.ping_timeout = 120  # drop a connection that has been silent this long
+        self.last_seen = 0.0
+        self.disconnected_at = None
+        self.watchdog_task = None
+        self.outbound = OutboundScheduler()
+        self.outbound_task = None
+        self.capture_path = capture_path
+        self.capture = None
+        # Read backend, buffer sizing and socket options for every connection
+        self.io_settings = io_settings or IOSettings()
+        # Sheds display work and pauses reads when the backlog behind the connection grows
+        self.overload = OverloadGuard.from_config(overload_settings)
+        self.overload.report = lambda msg: self.log_callback(msg)
+        if history is not None:
+            self.overload.watch(history.queue.qsize)
+        self.bytes_received = registry.counter("bytes_received")
+        self.reads = registry.counter("socket_reads")
+        self.reconnect_count = registry.counter("reconnects")
+        # Always an engine, so plugins have one to add triggers to
+        if triggers is None:
+            triggers = TriggerEngine()
+        self.triggers = triggers
+        # Trigger replies go out through the rate-limited outbound queue
+        if triggers.send is None:
+            triggers.send = self.send_command
+        triggers.ignore.add(uname.lower())
+        self.overload.watch(lambda: len(triggers.tasks))
 
         self.message_handler = MessageHandler(
             send_pong=self.send_pong,
             log_callback=lambda msg: self.log_callback(msg),
-            ui_callback=self.ui_callback
+            ui_callback=self.ui_callback,
+            history=history,
+            triggers=triggers,
+            plugins=plugins,
+            overload=self.overload
         )
+        # /whois and friends as awaitable, cached queries
+        self.queries = QueryEngine(lambda command: self.outbound.enqueue(command),
+                                   connected=lambda: bool(self.writer and self.running))
+        self.queries.attach(self.message_handler.dispatch)
 
     async def connect(self):
-        print("AsyncClient: Starting connect")
+        """Connect, then keep reconnecting with backoff until stop() is called."""
+        logger.debug("Starting connect for %s", self.uname)
         self.running = True
+        attempt = 0
+        try:
+            while self.running:
+                connected_for = await self.run_session()
+                if not self.running:
+                    break
+                if connected_for >= self.stable_after:
+                    attempt = 0
+                delay = self.backoff_delay(attempt)
+                attempt += 1
+                self.state = BACKOFF
+                self.log_callback(f"Attempting to reconnect in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+                if not self.running:
+                    break
+                self.expire_session()
+                self.reconnects += 1
+                self.reconnect_count.inc()
+        finally:
+            self.state = STOPPED
+            self.expire_session(force=True)
+            if self.capture is not None:
+                self.capture.close()
+                self.capture = None
+            self.triggers.close()
+
+    async def run_session(self):
+        """Make one connection and read until it drops; returns how long it was up."""
+        self.state = CONNECTING
+        connected_at = None
         try:
-            print(f"AsyncClient: Attempting connection to {self.host}:{self.port}")
+            logger.info("Connecting to %s:%s as %s", self.host, self.port, self.uname)
             self.reader, self.writer = await asyncio.wait_for(
-                asyncio.open_connection(self.host, self.port),
+                open_connection(self.host, self.port, self.io_settings),
                 timeout=self.timeout
             )
-            print("AsyncClient: Connection established")
+            connected_at = self.last_seen = time.monotonic()
+            self.state = CONNECTED
+            self.disconnected_at = None
+            logger.info("Connection established for %s", self.uname)
             self.log_callback(f"Connected to {self.host}:{self.port}")
-            login_message = f"C1\r\nACCT {self.uname}\r\nPASS {self.upass}\r\nHOME {self.uhome}\r\nLOGIN\r\n"
-            self.writer.write(login_message.encode('utf-8'))
-            await self.writer.drain()
-            print("AsyncClient: Login sequence sent")
+            self.outbound.reset()
+            # Log straight back into the channel we were in, so a blip resumes rather than restarts
+            home = self.message_handler.current_channel or self.uhome
+            for line in ("C1", f"ACCT {self.uname}", f"PASS {self.upass}", f"HOME {home}", "LOGIN"):
+                self.outbound.enqueue(line, PRIORITY_CONTROL)
+            self.outbound_task = asyncio.create_task(self.outbound.run(self.writer))
+            self.watchdog_task = asyncio.create_task(self.watchdog())
+            logger.debug("Login sequence queued for %s", self.uname)
             await self.receive_data()
         except ConnectionRefusedError as e:
             self.log_callback(f"Connection refused: {e}")
-            await self.cleanup()
         except asyncio.TimeoutError as e:
             self.log_callback(f"Connection timed out: {e}")
-            await self.cleanup()
         except Exception as e:
             self.log_callback(f"Connection error: {e}")
+        finally:
             await self.cleanup()
+        return time.monotonic() - connected_at if connected_at is not None else 0.0
 
-    async def reconnect(self):
-        self.log_callback(f"Attempting to reconnect in {self.delay} seconds...")
-        await asyncio.sleep(self.delay)
-        if self.running:
-            await self.connect()
+    def backoff_delay(self, attempt):
+        """Seconds to wait before reconnect attempt number attempt, counting from 0."""
+        if attempt == 0:
+            base = self.first_delay
+        else:
+            base = min(self.max_delay, self.delay * 2 ** (attempt - 1))
+        # Keep half the delay and randomize the rest so many bots do not retry in lockstep
+        return base / 2 + random.uniform(0, base / 2)
+
+    async def watchdog(self):
+        """Close the connection once nothing, not even a PING, has arrived for ping_timeout seconds."""
+        while True:
+            await asyncio.sleep(self.ping_timeout / 4)
+            if time.monotonic() - self.last_seen > self.ping_timeout:
+                logger.warning("No data from server for %ss, dropping connection for %s", self.ping_timeout, self.uname)
+                self.log_callback("Server stopped responding")
+                self.writer.close()
+                return
+
+    def expire_session(self, force=False):
+        """Forget the rosters and channels once an outage outlasts resume_window."""
+        handler = self.message_handler
+        if not force and (self.disconnected_at is None or time.monotonic() - self.disconnected_at < self.resume_window):
+            return
+        if not handler.channels and not len(handler.roster):
+            return
+        cleared = handler.reset_channels()
+        if self.ui_callback is not None:
+            self.ui_callback([cleared])
 
     async def receive_data(self):
-        buffer = ""
+        self.message_handler.framer.reset()
+        if self.capture_path and self.capture is None:
+            self.capture = CaptureWriter(self.capture_path)
         while self.running:
             try:
-                data = await self.reader.read(1024)
+                await self.overload.wait()
+                data = await self.reader.read()
                 if not data:
                     break
-                buffer += data.decode('utf-8')
-                buffer = await self.message_handler.process_buffer(buffer)
+                self.last_seen = time.monotonic()
+                self.reads.inc()
+                self.bytes_received.inc(len(data))
+                if self.capture is not None:
+                    self.capture.write(data)
+                await self.message_handler.process_buffer(data)
+            except ConnectionError as e:
+                # A reset is just another way for the connection to end; no traceback needed
+                logger.warning("Connection lost for %s: %s", self.uname, e)
+                break
             except Exception as e:
-                print(f"Receive error: {e}\n{traceback.format_exc()}")
+                logger.exception("Receive error for %s: %s", self.uname, e)
                 break
-        await self.cleanup()
 
     async def send_pong(self, ping_id):
-        pong_response = f"/PONG {ping_id}\r\n"
-        self.writer.write(pong_response.encode('utf-8'))
-        await self.writer.drain()
+        self.outbound.enqueue(f"/PONG {ping_id}", PRIORITY_CONTROL)
 
-    async def send_command(self, command):
+    async def send_command(self, command, priority=None):
         if self.writer and self.running:
-            try:
-                self.writer.write(f"{command}\r\n".encode('utf-8'))
-                await self.writer.drain()
-            except Exception as e:
-                print(f"Send error: {e}")
+            self.submit(command, priority)
+
+    def submit(self, command, priority=None):
+        """Queue a command on the loop thread, letting the query engine see any question it asks."""
+        self.queries.track(command)
+        self.outbound.enqueue(command, priority)
+
+    async def query(self, kind, target, fresh=False):
+        """Ask the server a question such as "whois" and wait for the answer; see QueryEngine."""
+        return await self.queries.query(kind, target, fresh)
 
     async def cleanup(self):
-        print("AsyncClient: Cleaning up")
+        """Tear down one connection; the roster and channel survive for a possible resume."""
+        logger.debug("Cleaning up %s", self.uname)
+        for task in (self.outbound_task, self.watchdog_task):
+            if task is not None:
+                task.cancel()
+        self.outbound_task = None
+        self.watchdog_task = None
+        # Answers to anything still outstanding will never arrive on a new connection
+        self.queries.fail_pending(ConnectionError("connection closed"))
         if self.writer:
             self.writer.close()
+            self.log_callback("Connection closed")
         self.reader = None
         self.writer = None
-        self.log_callback("Connection closed")
-        self.channel_users = []
-        self.message_handler.channel_users = []
-        self.message_handler.current_channel = None
-        if self.ui_callback is not None:
-            self.ui_callback(self.message_handler.channel_users)
-        if self.running:
-            await self.reconnect()
+        if self.disconnected_at is None:
+            self.disconnected_at = time.monotonic()
+        self.state = DISCONNECTED
+        if self.capture is not None:
+            self.capture.flush()
 
     def start(self):
-        print("AsyncClient: Scheduling connect")
+        logger.debug("Scheduling connect for %s", self.uname)
         asyncio.run_coroutine_threadsafe(self.connect(), self.loop)
 
     def stop(self):
-        print("AsyncClient: Stopping")
+        logger.info("Stopping %s", self.uname)
         self.running = False
 
     def send(self, command):
         if self.running:
-            print(f"AsyncClient: Scheduling send: {command}")
-            asyncio.run_coroutine_threadsafe(self.send_command(command), self.loop)
+            logger.debug("Scheduling send: %s", command)
+            self.loop.call_soon_threadsafe(self.submit, command)
+
+    def resend_roster(self):
+        """Post the current roster to the UI in full, e.g. after the UI dropped deltas."""
+        if self.ui_callback is not None:
+            self.ui_callback(self.message_handler.roster.snapshot())
 
     def set_ui_callback(self, ui_callback):
         if not callable(ui_callback):
@@ -0,0 +1,112 @@
+import asyncio
+import importlib
+import itertools
+import sys
+
+# Subtype key for subscribers that want every frame of a type, and for types without subtypes
+ANY = sys.intern("*")
+
+# A subscriber returning STOP keeps later subscribers from seeing the frame
+STOP = object()
+
+
+class Subscription:
+    __slots__ = ("msg_type", "subtype", "callback", "priority", "order", "is_async")
+
+    def __init__(self, msg_type, subtype, callback, priority, order):
+        self.msg_type = msg_type
+        self.subtype = subtype
+        self.callback = callback
+        self.priority = priority
+        self.order = order
+        self.is_async = asyncio.iscoroutinefunction(callback)
+
+
+class Route:
+    """Compiled subscribers for one (type, subtype) key, in call order."""
+
+    __slots__ = ("msg_type", "subtype", "handlers", "timer")
+
+    def __init__(self, msg_type, subtype, handlers):
+        self.msg_type = msg_type
+        self.subtype = subtype
+        # (callback, is_async) pairs
+        self.handlers = handlers
+        # Filled in by the dispatcher the first time the route is used
+        self.timer = None
+
+
+class DispatchRegistry:
+    """Subscribers for protocol frames, compiled into one flat (type, subtype) table.
+
+    Subscribers register for a type and subtype, or for every subtype of a
+    type with ANY, and run in priority order (lower first, then in order of
+    registration). compile() folds the ANY subscribers into each subtype's
+    route, so dispatching a frame is one dict lookup whatever the number of
+    subscribers, and a frame nobody subscribed to costs nothing more.
+    """
+
+    def __init__(self):
+        self.subscriptions = []
+        self.table = None
+        self.types = frozenset()
+        self.sequence = itertools.count()
+
+    def subscribe(self, msg_type, subtype=ANY, callback=None, priority=100):
+        """Register callback(parts) for frames of msg_type/subtype; without callback, acts as a decorator."""
+        if callback is None:
+            def register(callback):
+                self.subscribe(msg_type, subtype, callback, priority)
+                return callback
+            return register
+        if not callable(callback):
+            raise ValueError("callback must be callable")
+        self.subscriptions.append(Subscription(
+            sys.intern(msg_type), sys.intern(subtype), callback, priority, next(self.sequence)
+        ))
+        self.table = None
+        return callback
+
+    on = subscribe
+
+    def unsubscribe(self, callback):
+        before = len(self.subscriptions)
+        self.subscriptions = [s for s in self.subscriptions if s.callback != callback]
+        if len(self.subscriptions) == before:
+            raise ValueError("callback is not subscribed")
+        self.table = None
+
+    def compile(self):
+        grouped = {}
+        for subscription in self.subscriptions:
+            grouped.setdefault((subscription.msg_type, subscription.subtype), []).append(subscription)
+        # Whole-type subscribers also apply to every subtype that has its own route
+        for (msg_type, subtype), subscriptions in grouped.items():
+            if subtype is not ANY:
+                subscriptions.extend(grouped.get((msg_type, ANY), ()))
+        table = {}
+        for (msg_type, subtype), subscriptions in grouped.items():
+            subscriptions.sort(key=lambda s: (s.priority, s.order))
+            handlers = tuple((s.callback, s.is_async) for s in subscriptions)
+            table[(msg_type, subtype)] = Route(msg_type, subtype, handlers)
+        self.types = frozenset(msg_type for msg_type, _ in table)
+        self.table = table
+        return table
+
+    def route(self, parts):
+        """The route for a frame, or None if nobody subscribed to it."""
+        table = self.table if self.table is not None else self.compile()
+        route = table.get((parts[0], parts[1])) if len(parts) > 1 else None
+        if route is None:
+            route = table.get((parts[0], ANY))
+        return route
+
+
+def load_plugins(handler, modules):
+    """Import each module and call its setup(handler) so it can subscribe on handler.dispatch."""
+    for name in modules:
+        module = importlib.import_module(name)
+        setup = getattr(module, "setup", None)
+        if setup is None:
+            raise ValueError(f"plugin {name!r} has no setup(handler)")
+        setup(handler)
@@ -0,0 +1,245 @@
+import asyncio
+import itertools
+
+# Line builders for the subset of the protocol MessageHandler understands.
+# Field positions match what the handlers read: flags, ping, name, then stats
+# or message text.
+
+
+def ping(ping_id):
+    return f"PING {ping_id}"
+
+
+def server_info(text):
+    return f"SERVER INFO {text}"
+
+
+def server_topic(text):
+    return f"SERVER TOPIC {text}"
+
+
+def server_error(text):
+    return f"SERVER ERROR {text}"
+
+
+def server_broadcast(text):
+    return f"SERVER BROADCAST {text}"
+
+
+def channel_join(channel):
+    return f"CHANNEL JOIN {channel}"
+
+
+def user_in(name, flags="0010", ping_ms=0, stats="TAHC"):
+    return f"USER IN 0 0000 {flags} {ping_ms} {name} {stats}"
+
+
+def user_join(name, flags="0010", ping_ms=0, stats="TAHC"):
+    return f"USER JOIN 0 0000 {flags} {ping_ms} {name} {stats}"
+
+
+def user_update(name, flags="0010", ping_ms=0, stats="TAHC"):
+    return f"USER UPDATE 0 0000 {flags} {ping_ms} {name} {stats}"
+
+
+def user_leave(name, flags="0010", ping_ms=0):
+    return f"USER LEAVE 0 0000 {flags} {ping_ms} {name}"
+
+
+def user_talk(name, text, flags="0010", ping_ms=0):
+    return f"USER TALK FROM 0000 {flags} {ping_ms} {name} {text}"
+
+
+def user_whisper(name, text, flags="0010", ping_ms=0):
+    return f"USER WHISPER FROM 0000 {flags} {ping_ms} {name} {text}"
+
+
+def encode(lines):
+    return "".join(f"{line}\r\n" for line in lines).encode("utf-8")
+
+
+# Scripted load generators. Each returns a list of lines; scenarios below send
+# them in chunks so the client sees realistic read boundaries.
+
+def join_burst_lines(channel, users, operators=0):
+    lines = [channel_join(channel), server_info(f"Channel {channel} Topic: load test")]
+    for i in range(users):
+        flags = "18" if i < operators else "0010"
+        lines.append(user_in(f"user{i}", flags=flags, ping_ms=i % 300, stats=("TAHC", "PX2D", "RTSJ")[i % 3]))
+    return lines
+
+
+def storm_lines(users, cycles):
+    lines = []
+    for cycle in range(cycles):
+        for i in range(users):
+            lines.append(user_join(f"storm{i}"))
+        for i in range(users):
+            lines.append(user_leave(f"storm{i}"))
+    return lines
+
+
+def chat_lines(messages, users=50, text="the quick brown fox jumps over the lazy dog"):
+    return [user_talk(f"user{i % users}", f"{text} {i}") for i in range(messages)]
+
+
+class FakeSession:
+    """One connected client as seen by the fake server."""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.name = None
+        self.home = None
+        self.commands = []
+        self.pongs = []
+        self.queries = 0
+
+    async def send(self, lines, chunk=64):
+        """Write lines to the client, draining every chunk lines."""
+        for start in range(0, len(lines), chunk):
+            self.writer.write(encode(lines[start:start + chunk]))
+            await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+class FakeInit6Server:
+    """In-process asyncio stand-in for an Init6 chat server.
+
+    Accepts the C1/ACCT/PASS/HOME/LOGIN sequence, joins the client to its home
+    channel, sends PINGs every ping_interval seconds and runs an optional
+    scenario coroutine (called with the FakeSession) to generate load.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, scenario=None, ping_interval=None, close_after_scenario=False):
+        self.host = host
+        self.port = port
+        self.scenario = scenario
+        self.ping_interval = ping_interval
+        self.close_after_scenario = close_after_scenario
+        self.server = None
+        self.sessions = []
+        self.logins = 0
+        self.ping_ids = itertools.count(1)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        for session in list(self.sessions):
+            session.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def login(self, session):
+        while True:
+            line = await session.reader.readline()
+            if not line:
+                return False
+            line = line.decode("utf-8", "replace").strip()
+            key, _, value = line.partition(" ")
+            if key == "ACCT":
+                session.name = value
+            elif key == "HOME":
+                session.home = value
+            elif key == "LOGIN":
+                return True
+
+    async def handle(self, reader, writer):
+        session = FakeSession(self, reader, writer)
+        self.sessions.append(session)
+        tasks = []
+        try:
+            if not await self.login(session):
+                return
+            self.logins += 1
+            channel = session.home or "Void"
+            await session.send([
+                "OK",
+                server_info(f"Welcome to the fake Init6 server, {session.name}."),
+                channel_join(channel),
+                user_in(session.name),
+            ])
+            if self.ping_interval:
+                tasks.append(asyncio.create_task(self.pinger(session)))
+            if self.scenario is not None:
+                tasks.append(asyncio.create_task(self.run_scenario(session)))
+            await self.read_commands(session)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.sessions.remove(session)
+            writer.close()
+
+    async def run_scenario(self, session):
+        await self.scenario(session)
+        if self.close_after_scenario:
+            session.close()
+
+    async def pinger(self, session):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            session.writer.write(encode([ping(next(self.ping_ids))]))
+            await session.writer.drain()
+
+    async def read_commands(self, session):
+        while True:
+            line = await session.reader.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip()
+            if command.startswith("/PONG "):
+                session.pongs.append(command[6:])
+                continue
+            session.commands.append(command)
+            head, _, rest = command.partition(" ")
+            if head.lower() in ("/j", "/join") and rest:
+                await session.send([channel_join(rest), user_in(session.name)])
+            elif head.lower() in ("/whois", "/where") and rest:
+                session.queries += 1
+                if rest.lower().startswith("offline"):
+                    # Stand-in for a user who is not logged on
+                    await session.send([server_error("That user is not logged on.")])
+                else:
+                    await session.send([server_info(f"{rest} is using Diablo II in the channel "
+                                                    f"{session.home or 'Void'}.")])
+
+
+def burst_scenario(users=1000, chat=0):
+    """Scenario: join a channel of the given size, then optionally flood chat."""
+    async def scenario(session):
+        # A real server lists the joining client in the new channel too
+        await session.send(join_burst_lines(session.home or "Void", users) + [user_in(session.name)])
+        if chat:
+            await session.send(chat_lines(chat))
+    return scenario
+
+
+def storm_scenario(users=200, cycles=10):
+    """Scenario: repeated join/leave waves of the same users."""
+    async def scenario(session):
+        await session.send(storm_lines(users, cycles))
+    return scenario
+
+
+def flood_scenario(messages=10000, users=50):
+    """Scenario: a channel flooded with chat."""
+    async def scenario(session):
+        await session.send(chat_lines(messages, users))
+    return scenario
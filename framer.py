@@ -0,0 +1,74 @@
+import codecs
+
+# Number of single-space splits per message type (and subtype). The last field
+# keeps the rest of the line intact, so chat text is never re-joined. Types not
+# listed here are split on every space.
+FIELD_SPLITS = {
+    "SERVER": 2,
+    "CHANNEL": 2,
+    "USER": {
+        "TALK": 7,
+        "WHISPER": 7,
+        "EMOTE": 7,
+    },
+}
+
+CRLF = b"\r\n"
+
+
+def tokenize(line):
+    """Split a decoded Init6 line into fields according to FIELD_SPLITS."""
+    msg_type, _, rest = line.partition(" ")
+    splits = FIELD_SPLITS.get(msg_type, -1)
+    if splits.__class__ is dict:
+        splits = splits.get(rest.partition(" ")[0], -1)
+    return line.split(" ", splits)
+
+
+class FrameParser:
+    """Incremental CRLF framer for the Init6 chat protocol.
+
+    Bytes are accumulated in a bytearray and only complete frames are decoded.
+    A CRLF can never appear inside a multi-byte UTF-8 sequence, so a character
+    split across two reads simply stays in the buffer until its frame is done.
+    """
+
+    def __init__(self, max_frame=65536, encoding="utf-8"):
+        self.buffer = bytearray()
+        self.max_frame = max_frame
+        self.encoding = encoding
+        self.frames = 0
+        self.dropped = 0
+        codecs.lookup(encoding)
+
+    def reset(self):
+        self.buffer.clear()
+
+    def feed(self, data):
+        """Append raw bytes and return the tokenized frames completed by them."""
+        buf = self.buffer
+        buf += data
+        end = buf.rfind(CRLF)
+        if end < 0:
+            if len(buf) > self.max_frame:
+                # No terminator in sight; drop the partial frame instead of growing forever
+                self.dropped += 1
+                buf.clear()
+            return []
+
+        # Decode every complete frame from this read in one pass
+        view = memoryview(buf)
+        try:
+            text = str(view[:end], self.encoding, "replace")
+        finally:
+            view.release()
+        del buf[:end + 2]
+
+        frames = []
+        append = frames.append
+        for line in text.split("\r\n"):
+            line = line.strip()
+            if line:
+                append(tokenize(line))
+        self.frames += len(frames)
+        return frames
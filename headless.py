@@ -0,0 +1,84 @@
+import asyncio
+import sys
+from client import AsyncClient
+from metrics import start_exporters
+
+
+class StdoutSink:
+    """Write log messages to standard output."""
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+
+    def write(self, message):
+        self.stream.write(message + "\n")
+
+    def close(self):
+        self.stream.flush()
+
+
+class FileSink:
+    """Append log messages to a file."""
+
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, message):
+        self.file.write(message + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class CallbackSink:
+    """Forward log messages to an arbitrary callable."""
+
+    def __init__(self, callback):
+        if not callable(callback):
+            raise ValueError("callback must be callable")
+        self.callback = callback
+
+    def write(self, message):
+        self.callback(message)
+
+    def close(self):
+        pass
+
+
+class HeadlessBot:
+    """Runs an AsyncClient on the current event loop with no UI attached."""
+
+    def __init__(self, host, port, uname, upass, uhome, sinks=(), capture_path=None, history=None, triggers=None,
+                 plugins=(), io_settings=None, overload_settings=None):
+        self.sinks = list(sinks)
+        self.client = AsyncClient(host, port, uname, upass, uhome, self.emit, None,
+                                  capture_path=capture_path, history=history, triggers=triggers,
+                                  plugins=plugins, io_settings=io_settings, overload_settings=overload_settings)
+
+    def emit(self, message):
+        for sink in self.sinks:
+            sink.write(message)
+
+    async def run(self, metrics_config=None):
+        self.client.loop = asyncio.get_running_loop()
+        if metrics_config:
+            await start_exporters(metrics_config)
+        try:
+            await self.client.connect()
+        finally:
+            for sink in self.sinks:
+                sink.close()
+
+    def stop(self):
+        self.client.stop()
+
+
+def run_headless(host, port, uname, upass, uhome, sinks=(), capture_path=None, metrics_config=None, history=None,
+                 triggers=None, plugins=(), io_settings=None, overload_settings=None):
+    """Run a single bot until interrupted, using asyncio.run."""
+    bot = HeadlessBot(host, port, uname, upass, uhome, sinks, capture_path, history, triggers, plugins, io_settings,
+                      overload_settings)
+    try:
+        asyncio.run(bot.run(metrics_config))
+    except KeyboardInterrupt:
+        bot.stop()
@@ -0,0 +1,195 @@
+import queue
+import re
+import sqlite3
+import threading
+import time
+from log_setup import get_logger
+from metrics import registry
+
+logger = get_logger("history")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    channel TEXT,
+    user TEXT,
+    kind TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+CREATE INDEX IF NOT EXISTS messages_channel_ts ON messages (channel, ts);
+CREATE INDEX IF NOT EXISTS messages_user_ts ON messages (user COLLATE NOCASE, ts);
+"""
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (text, content='messages', content_rowid='id');
+"""
+
+_STOP = object()
+_DURATION = re.compile(r"^(\d+)([smhdw])$")
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def has_fts5():
+    try:
+        sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE t USING fts5 (x)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def parse_query(query, now=None):
+    """Turn "user:bob channel:dark since:2d hello world" into search() arguments."""
+    now = now if now is not None else time.time()
+    criteria = {}
+    words = []
+    for token in query.split():
+        key, sep, value = token.partition(":")
+        if sep and value and key in ("user", "channel", "since", "until"):
+            if key in ("since", "until"):
+                match = _DURATION.match(value)
+                if not match:
+                    raise ValueError(f"bad duration {value!r}, expected e.g. 30m, 2h or 7d")
+                value = now - int(match.group(1)) * _UNITS[match.group(2)]
+            criteria[key] = value
+        else:
+            words.append(token)
+    if words:
+        criteria["text"] = " ".join(words)
+    return criteria
+
+
+class HistoryStore:
+    """Persistent chat history in SQLite, with an FTS5 index when available.
+
+    record() only puts the row on a queue. A writer thread owns the write
+    connection and group-commits whatever has accumulated, up to batch_size
+    rows per transaction, so the event loop never waits on disk. While
+    max_queued rows are waiting, further rows are dropped and counted
+    rather than queued.
+    """
+
+    def __init__(self, path, batch_size=500, flush_interval=0.5, max_queued=100000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queued = max_queued
+        self.queue = queue.SimpleQueue()
+        self.dropped = registry.counter("history_dropped")
+        self.fts = has_fts5()
+        self.written = 0
+        self.read_lock = threading.Lock()
+
+        # Create the schema up front so searches work before the first write
+        connection = self.connect()
+        connection.executescript(SCHEMA)
+        if self.fts:
+            connection.executescript(FTS_SCHEMA)
+        connection.commit()
+        self.reader = connection
+
+        self.thread = threading.Thread(target=self.write_loop, name="pchat-history", daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def record(self, kind, channel, user, text, ts=None):
+        """Queue a message for writing; safe to call from any thread."""
+        if self.queue.qsize() >= self.max_queued:
+            self.dropped.inc()
+            return
+        self.queue.put((ts if ts is not None else time.time(), channel, user, kind, text))
+
+    def write_loop(self):
+        connection = self.connect()
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            rows = []
+            markers = []
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                if isinstance(item, threading.Event):
+                    markers.append(item)
+                else:
+                    rows.append(item)
+                    if len(rows) >= self.batch_size:
+                        break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if rows:
+                try:
+                    self.write_batch(connection, rows)
+                except sqlite3.Error:
+                    logger.exception("Failed to write %d history rows", len(rows))
+            for marker in markers:
+                marker.set()
+        connection.close()
+
+    def write_batch(self, connection, rows):
+        with connection:
+            last_id = connection.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+            connection.executemany(
+                "INSERT INTO messages (ts, channel, user, kind, text) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            if self.fts:
+                connection.execute(
+                    "INSERT INTO messages_fts (rowid, text) SELECT id, text FROM messages WHERE id > ?", (last_id,)
+                )
+        self.written += len(rows)
+
+    def search(self, channel=None, user=None, since=None, until=None, text=None, limit=200):
+        """Return (ts, channel, user, kind, text) rows, newest first."""
+        clauses = []
+        params = []
+        table = "messages m"
+        if text:
+            if self.fts:
+                table = "messages_fts f JOIN messages m ON m.id = f.rowid"
+                clauses.append("messages_fts MATCH ?")
+                # Quote every word so user input is never parsed as FTS syntax
+                params.append(" ".join('"' + word.replace('"', '""') + '"' for word in text.split()))
+            else:
+                for word in text.split():
+                    clauses.append("m.text LIKE ?")
+                    params.append(f"%{word}%")
+        if channel:
+            clauses.append("m.channel = ?")
+            params.append(channel)
+        if user:
+            clauses.append("m.user = ? COLLATE NOCASE")
+            params.append(user)
+        if since is not None:
+            clauses.append("m.ts >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("m.ts < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = f"SELECT m.ts, m.channel, m.user, m.kind, m.text FROM {table} {where} ORDER BY m.ts DESC LIMIT ?"
+        params.append(limit)
+        with self.read_lock:
+            return self.reader.execute(sql, params).fetchall()
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued so far has been written."""
+        marker = threading.Event()
+        self.queue.put(marker)
+        return marker.wait(timeout)
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+        with self.read_lock:
+            self.reader.close()
@@ -0,0 +1,97 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOGGER_NAME = "pchat"
+TEXT_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_FIELDS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+def get_logger(name):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+class LazyJoin:
+    """Joins message fields only if a handler actually formats the record."""
+
+    __slots__ = ("parts",)
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __str__(self):
+        return " ".join(self.parts)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including any extra= fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records untouched so formatting happens on the listener thread.
+
+    The stock QueueHandler formats in prepare(), which would put the string
+    work back on the event loop thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(settings=None):
+    """Configure the pchat logger from the "logging" section of config.json.
+
+    Records are handed to a queue and written by a background listener thread,
+    to stderr and/or a size-rotated file. Returns the listener; call its stop()
+    at exit to flush. Calling this again replaces the previous setup.
+    """
+    settings = settings or {}
+    level = settings.get("level", "INFO")
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+        if not isinstance(level, int):
+            raise ValueError(f"unknown log level {settings['level']!r}")
+
+    formatter = JsonFormatter() if settings.get("format") == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = []
+    if settings.get("console", True):
+        handlers.append(logging.StreamHandler(sys.stderr))
+    if settings.get("file"):
+        handlers.append(logging.handlers.RotatingFileHandler(
+            settings["file"],
+            maxBytes=settings.get("max_bytes", 10 * 1024 * 1024),
+            backupCount=settings.get("backups", 5),
+            encoding="utf-8"
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    logger = logging.getLogger(LOGGER_NAME)
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    records = queue.SimpleQueue()
+    logger.addHandler(DeferredQueueHandler(records))
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    return listener
@@ -1,52 +1,235 @@
+import argparse
 import asyncio
-import tkinter as tk
 import threading
 import time
 import json
 from client import AsyncClient
-from ui import BotUI
+from log_setup import get_logger, setup_logging
+from metrics import SamplingProfiler, start_exporters
+from offload import Offloader
+from overload import OverloadGuard
+from transport import IOSettings, install_event_loop
+
+logger = get_logger("main")
 
 # Global variable to hold the asyncio loop
 async_loop = None
 
+REQUIRED_KEYS = ('host', 'port', 'username', 'password', 'home_channel')
+
 def start_asyncio_loop():
     global async_loop
     async_loop = asyncio.new_event_loop()
     asyncio.set_event_loop(async_loop)
-    print("Async loop started")
+    logger.debug("Async loop started")
     async_loop.run_forever()
-    print("Async loop stopped")
-
-# Load settings from config.json
-try:
-    with open('config.json', 'r') as config_file:
-        config = json.load(config_file)
-    HOST = config['host']
-    PORT = config['port']
-    USERNAME = config['username']
-    PASSWORD = config['password']
-    HOME_CHANNEL = config['home_channel']
-except FileNotFoundError:
-    print("Error: config.json not found")
-    exit(1)
-except KeyError as e:
-    print(f"Error: Missing key {e} in config.json")
-    exit(1)
-
-# Start the asyncio thread
-loop_thread = threading.Thread(target=start_asyncio_loop, daemon=True)
-loop_thread.start()
-
-# Wait until the loop is initialized
-while async_loop is None:
-    time.sleep(0.1)
-
-# Create the client and UI
-root = tk.Tk()
-root.title("pchat")
-client = AsyncClient(HOST, PORT, USERNAME, PASSWORD, HOME_CHANNEL, None, async_loop)
-app = BotUI(root, client) # Create client
-client.log_callback = app.log  # Set the log callback
-client.set_ui_callback(app.update_user_list)  # Set ui_callback
-client.start()  # Start the client
-root.mainloop()
\ No newline at end of file
+    logger.debug("Async loop stopped")
+
+def load_config(path):
+    # Load settings from config.json
+    try:
+        with open(path, 'r') as config_file:
+            config = json.load(config_file)
+        for key in REQUIRED_KEYS:
+            if key not in config:
+                raise KeyError(key)
+    except FileNotFoundError:
+        print(f"Error: {path} not found")
+        exit(1)
+    except KeyError as e:
+        print(f"Error: Missing key {e} in {path}")
+        exit(1)
+    return config
+
+def start_profiler(config, thread_id):
+    # Opt-in sampling profiler for the thread running the event loop
+    if not config.get('profile_interval'):
+        return None
+    profiler = SamplingProfiler(thread_id, interval=config['profile_interval'])
+    profiler.start()
+    return profiler
+
+def stop_profiler(profiler):
+    if profiler is not None:
+        profiler.stop()
+        print(profiler.report())
+
+def open_history(config):
+    # Chat history store, only when history_file is configured
+    if not config.get('history_file'):
+        return None
+    from history import HistoryStore
+    return HistoryStore(config['history_file'])
+
+def check_overload_settings(config):
+    # Every client builds its guard from the "overload" section, so report a bad one before any starts
+    try:
+        OverloadGuard.from_config(config.get('overload'))
+    except ValueError as e:
+        print(f"Error: {e}")
+        exit(1)
+
+def build_offload_settings(config):
+    # Offload pool options for triggers, from the top-level offload_* keys
+    settings = {'mode': config.get('offload_mode', 'thread'), 'workers': config.get('offload_workers'),
+                'max_pending': config.get('offload_queue', 64)}
+    try:
+        Offloader.check(**settings)
+    except ValueError as e:
+        print(f"Error: {e}")
+        exit(1)
+    return settings
+
+def build_triggers(config, offload_settings=None):
+    # Triggers from config; the engine exists even without any so plugins can add their own
+    from triggers import TriggerEngine, load_triggers
+    engine = TriggerEngine(offloader=Offloader.from_config(offload_settings))
+    try:
+        return load_triggers(engine, config.get('triggers') or ())
+    except ValueError as e:
+        print(f"Error: {e}")
+        exit(1)
+
+def build_io_settings(config):
+    # Socket backend and options from the optional "io" section
+    try:
+        return IOSettings.from_config(config.get('io'))
+    except ValueError as e:
+        print(f"Error: {e}")
+        exit(1)
+
+def run_gui(config, history=None, io_settings=None, offload_settings=None):
+    # GUI modules pull in Tk and PIL, so only import them when a window is wanted
+    import tkinter as tk
+    from ui import BotUI
+    from ui_bridge import UIBridge
+
+    # Start the asyncio thread
+    loop_thread = threading.Thread(target=start_asyncio_loop, daemon=True)
+    loop_thread.start()
+
+    # Wait until the loop is initialized
+    while async_loop is None:
+        time.sleep(0.1)
+
+    asyncio.run_coroutine_threadsafe(start_exporters(config), async_loop)
+    profiler = start_profiler(config, loop_thread.ident)
+
+    # Create the client and UI
+    root = tk.Tk()
+    root.title("pchat")
+    triggers = build_triggers(config, offload_settings)
+    client = AsyncClient(config['host'], config['port'], config['username'], config['password'],
+                         config['home_channel'], None, async_loop, capture_path=config.get('capture_file'),
+                         history=history, triggers=triggers,
+                         plugins=config.get('plugins') or (), io_settings=io_settings,
+                         overload_settings=config.get('overload'))
+    app = BotUI(root, client, scrollback_lines=config.get('scrollback_lines', 2000), history=history) # Create client
+    # Marshal client events onto the Tk thread; if it falls behind and drops roster deltas, resend the roster
+    bridge = UIBridge(root, app, resync=lambda: async_loop.call_soon_threadsafe(client.resend_roster))
+    client.log_callback = bridge.post_log  # Set the log callback
+    client.set_ui_callback(bridge.post_roster)  # Set ui_callback
+    client.overload.watch(lambda: bridge.depth)  # Events the Tk side has not drawn yet count as backlog
+    bridge.start()
+    client.start()  # Start the client
+    root.mainloop()
+    triggers.offloader.close()
+    stop_profiler(profiler)
+
+def run_headless(config, log_file=None, quiet=False, history=None, io_settings=None, offload_settings=None):
+    from headless import StdoutSink, FileSink, run_headless as run_bot
+
+    sinks = []
+    if not quiet:
+        sinks.append(StdoutSink())
+    if log_file:
+        sinks.append(FileSink(log_file))
+    triggers = build_triggers(config, offload_settings)
+    profiler = start_profiler(config, threading.main_thread().ident)
+    try:
+        run_bot(config['host'], config['port'], config['username'], config['password'],
+                config['home_channel'], sinks, capture_path=config.get('capture_file'), metrics_config=config,
+                history=history, triggers=triggers, plugins=config.get('plugins') or (),
+                io_settings=io_settings, overload_settings=config.get('overload'))
+    finally:
+        triggers.offloader.close()
+    stop_profiler(profiler)
+
+def run_pool(config, workers=None, log_file=None, quiet=False, history=None, io_settings=None,
+             offload_settings=None):
+    from headless import StdoutSink, FileSink
+    from session_pool import SessionPool, load_accounts, run_sharded
+
+    try:
+        accounts = load_accounts(config)
+    except KeyError as e:
+        print(f"Error: Missing key {e} for account in config")
+        exit(1)
+    if workers is not None:
+        run_sharded(accounts, workers=workers, logging_settings=config.get('logging'),
+                    triggers=config.get('triggers') or (), plugins=config.get('plugins') or (),
+                    io_settings=io_settings, overload_settings=config.get('overload'),
+                    offload_settings=offload_settings)
+        return
+
+    sinks = []
+    if not quiet:
+        sinks.append(StdoutSink())
+    if log_file:
+        sinks.append(FileSink(log_file))
+    pool = SessionPool(accounts, sinks, history=history, triggers=config.get('triggers') or (),
+                       plugins=config.get('plugins') or (), io_settings=io_settings,
+                       overload_settings=config.get('overload'), offload_settings=offload_settings)
+
+    async def run():
+        await start_exporters(config)
+        await pool.run()
+
+    profiler = start_profiler(config, threading.main_thread().ident)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pool.stop()
+    stop_profiler(profiler)
+
+def main():
+    parser = argparse.ArgumentParser(description="Python chatbot for the Init6 protocol")
+    parser.add_argument("--config", default="config.json", help="path to the config file")
+    parser.add_argument("--headless", action="store_true", help="run without a window")
+    parser.add_argument("--log-file", help="append chat output to this file (headless only)")
+    parser.add_argument("--quiet", action="store_true", help="do not echo chat output to stdout (headless only)")
+    parser.add_argument("--log-level", help="override logging.level from the config (e.g. DEBUG)")
+    parser.add_argument("--pool", action="store_true", help="run every account in config['accounts'] headless on one loop")
+    parser.add_argument("--workers", type=int, metavar="N",
+                        help="with --pool, shard accounts across N worker processes (0 = CPU count)")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    logging_settings = dict(config.get('logging') or {})
+    if args.log_level:
+        logging_settings['level'] = args.log_level
+    config['logging'] = logging_settings
+    listener = setup_logging(logging_settings)
+    io_settings = build_io_settings(config)
+    # Must happen before any loop is created, including the GUI's loop thread
+    loop_kind = install_event_loop(io_settings.loop)
+    logger.debug("Using the %s event loop with the %s backend", loop_kind, io_settings.backend)
+    check_overload_settings(config)
+    offload_settings = build_offload_settings(config)
+    history = open_history(config)
+    try:
+        if args.pool:
+            run_pool(config, workers=args.workers, log_file=args.log_file, quiet=args.quiet, history=history,
+                     io_settings=io_settings, offload_settings=offload_settings)
+        elif args.headless:
+            run_headless(config, log_file=args.log_file, quiet=args.quiet, history=history, io_settings=io_settings,
+                         offload_settings=offload_settings)
+        else:
+            run_gui(config, history=history, io_settings=io_settings, offload_settings=offload_settings)
+    finally:
+        if history is not None:
+            history.close()
+        listener.stop()
+
+if __name__ == "__main__":
+    main()
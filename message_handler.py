@@ -1,19 +1,38 @@
-import re
 import time
+from logging import DEBUG
 import asyncio
-from collections import namedtuple
-from collections import deque
+from collections import OrderedDict
+from channels import ChannelState
+from dispatch import ANY, STOP, DispatchRegistry, load_plugins
+from framer import FrameParser
+from log_setup import LazyJoin, get_logger
+from metrics import registry, SIZE_BOUNDS
+from presence import PresenceEngine, summarize
+from roster import RosterCleared
 
-# User data structure
-User = namedtuple("User", ["name", "flags", "ping", "stats"])
+logger = get_logger("handler")
 
 class MessageHandler:
-    def __init__(self, send_pong, log_callback, ui_callback=None):
-        self.channel_users = []
-        self.current_channel = None
+    def __init__(self, send_pong, log_callback, ui_callback=None, history=None, triggers=None, plugins=(),
+                 overload=None, max_channels=32):
+        if max_channels < 1:
+            raise ValueError("max_channels must be at least 1")
+        # The channels this session was in most recently, by lowercased name, and the one it is in now
+        self.channels = OrderedDict()
+        self.max_channels = max_channels
+        self.channel = ChannelState(None)
+        # Names carried over from before a rejoin, dropped unless the server lists them again
+        self.stale = None
+        # While the server relists a known channel: the timer that ends the listing once USER INs stop
+        self.listing = None
+        self.list_settle = 1.0
         self.send_pong = send_pong
         self.log_callback = log_callback
         self.ui_callback = ui_callback
+        self.history = history
+        self.triggers = triggers
+        self.overload = overload
+        self.framer = FrameParser()
 
         # Validate callbacks
         if not callable(log_callback):
@@ -23,67 +42,110 @@ class MessageHandler:
         if ui_callback is not None and not callable(ui_callback):
             raise ValueError("ui_callback must be callable")
 
-        # Batch processing for user messages
-        self.user_message_queue = deque()
+        # User messages are coalesced per user and applied once per presence window
+        self.presence = PresenceEngine()
         self.batch_task = None
-        self.batch_delay = 0.5
-        self.last_join_msg = time.time()
-        self.last_leave_msg = time.time()
-
-        # Dispatch table for message types
-        self.message_handlers = {
-            "PING": self.handle_ping,
-            "SERVER": {
-                "INFO": self.handle_server_info,
-                "TOPIC": self.handle_server_topic,
-                "UPDATE": self.handle_server_update,
-                "ERROR": self.handle_server_error,
-                "BROADCAST": self.handle_server_broadcast
-            },
-            "CHANNEL": {
-                "JOIN": self.handle_channel_join
-            },
-            "USER": {
-                "IN": self.queue_user_message,
-                "UPDATE": self.queue_user_message,
-                "JOIN": self.queue_user_message,
-                "LEAVE": self.queue_user_message,
-                "TALK": self.handle_user_talk,
-                "WHISPER": self.handle_user_whisper
-            }
-        }
-
-    async def process_buffer(self, buffer):
-        while '\r\n' in buffer:
-            message, buffer = buffer.split('\r\n', 1)
-            message = message.strip()
-            if message:
-                parts = re.split(r'\s', message)
-                try:
-                    await self.handle_message(parts)
-                except Exception as e:
-                    self.log_callback(f"Error in handle_message: {e}")
-                    raise
-        return buffer
+
+        # Instrumentation
+        self.frames_received = registry.counter("frames_received")
+        self.batch_sizes = registry.histogram("user_batch_size", SIZE_BOUNDS)
+        self.presence_coalesced = registry.counter("presence_coalesced")
+        self.handler_timers = {}
+
+        # Built-in handlers run ahead of plugin subscribers at the default priority
+        self.dispatch = DispatchRegistry()
+        for msg_type, subtype, callback in (
+            ("PING", ANY, self.handle_ping),
+            ("SERVER", "INFO", self.handle_server_info),
+            ("SERVER", "TOPIC", self.handle_server_topic),
+            ("SERVER", "UPDATE", self.handle_server_update),
+            ("SERVER", "ERROR", self.handle_server_error),
+            ("SERVER", "BROADCAST", self.handle_server_broadcast),
+            ("CHANNEL", "JOIN", self.handle_channel_join),
+            ("USER", "IN", self.queue_user_message),
+            ("USER", "UPDATE", self.queue_user_message),
+            ("USER", "JOIN", self.queue_user_message),
+            ("USER", "LEAVE", self.queue_user_message),
+            ("USER", "TALK", self.handle_user_talk),
+            ("USER", "WHISPER", self.handle_user_whisper),
+        ):
+            self.dispatch.subscribe(msg_type, subtype, callback, priority=0)
+        load_plugins(self, plugins)
+
+    async def process_buffer(self, data):
+        """Feed raw bytes from the socket and dispatch every completed frame."""
+        frames = self.framer.feed(data)
+        self.frames_received.inc(len(frames))
+        # Answer PINGs before the rest of the batch so a long read never delays a PONG
+        pings = [parts for parts in frames if parts and parts[0] == "PING"]
+        if pings:
+            frames = pings + [parts for parts in frames if not parts or parts[0] != "PING"]
+        for parts in frames:
+            try:
+                await self.handle_message(parts)
+            except Exception as e:
+                self.log_callback(f"Error in handle_message: {e}")
+                raise
 
     async def handle_message(self, parts):
-        if not parts or parts[0] == "OK":
+        if not parts:
             return
         msg_type = parts[0]
-        if not msg_type == "PING":
-            print(' '.join(parts[0:]))
-        handler = self.message_handlers.get(msg_type)
-        if isinstance(handler, dict):
-            submsg_type = parts[1] if len(parts) > 1 else ""
-            subhandler = handler.get(submsg_type)
-            if subhandler:
-                await subhandler(parts)
-            else:
+        if msg_type != "PING" and logger.isEnabledFor(DEBUG):
+            logger.debug("%s", LazyJoin(parts))
+        # The user list after a join is USER INs, possibly mixed with SERVER lines; anything else ends it
+        if self.listing is not None and msg_type not in ("PING", "SERVER") and (
+                msg_type != "USER" or parts[1] != "IN"):
+            self.end_listing()
+        route = self.dispatch.route(parts)
+        if route is None:
+            if msg_type == "OK":
+                return
+            if msg_type in self.dispatch.types:
+                submsg_type = parts[1] if len(parts) > 1 else ""
                 self.log_callback(f"Unknown submsg_type: {submsg_type} for msg_type: {msg_type}")
-        elif handler:
-            await handler(parts)
-        else:
-            self.log_callback(f"Unknown msg_type: {msg_type}")
+            else:
+                self.log_callback(f"Unknown msg_type: {msg_type}")
+            return
+        start = time.perf_counter()
+        for callback, is_async in route.handlers:
+            result = callback(parts)
+            if is_async:
+                result = await result
+            if result is STOP:
+                break
+        timer = route.timer
+        if timer is None:
+            timer = route.timer = self.handler_timer(route.msg_type, route.subtype)
+        timer.observe(time.perf_counter() - start)
+
+    def handler_timer(self, msg_type, submsg_type):
+        key = (msg_type, submsg_type)
+        timer = self.handler_timers.get(key)
+        if timer is None:
+            if submsg_type and submsg_type != ANY:
+                name = f"handler_seconds.{msg_type}.{submsg_type}"
+            else:
+                name = f"handler_seconds.{msg_type}"
+            timer = self.handler_timers[key] = registry.histogram(name)
+        return timer
+
+    @property
+    def roster(self):
+        return self.channel.roster
+
+    @property
+    def current_channel(self):
+        return self.channel.name
+
+    def reset_channels(self):
+        """Forget every channel, e.g. after a long outage; returns the delta for the UI."""
+        self.channels.clear()
+        self.channel = ChannelState(None)
+        self.stale = None
+        self.end_listing()
+        self.presence.clear()
+        return RosterCleared()
 
     async def handle_ping(self, parts):
         if len(parts) >= 2:
@@ -92,111 +154,168 @@ class MessageHandler:
 
     async def handle_server_info(self, parts):
         info = ' '.join(parts[2:]).strip()
-        if len(parts) > 6 and parts[5] == "Topic:":
-            topic = ' '.join(parts[6:]).strip()
+        fields = info.split(' ', 4)
+        if len(fields) > 4 and fields[3] == "Topic:":
+            topic = fields[4].strip()
+            self.record_history("topic", None, topic)
             self.log_callback(f"CHANNEL_TOPIC {topic}")
         else:
+            self.record_history("info", None, info)
             self.log_callback(info)
 
     async def handle_server_topic(self, parts):
         topic = ' '.join(parts[2:]).strip()
+        self.record_history("topic", None, topic)
         self.log_callback(topic)
 
     async def handle_server_update(self, parts):
         update = ' '.join(parts[2:]).strip()
+        self.record_history("update", None, update)
         self.log_callback(update)
 
     async def handle_server_error(self, parts):
         error = ' '.join(parts[2:]).strip()
+        self.record_history("error", None, error)
         self.log_callback(error)
 
     async def handle_server_broadcast(self, parts):
         broadcast = ' '.join(parts[2:]).strip()
+        self.record_history("broadcast", None, broadcast)
         self.log_callback(broadcast)
 
     async def handle_channel_join(self, parts):
-        self.channel_users = []
-        self.current_channel = ' '.join(parts[2:]).strip()
-        self.log_callback(f"CHANNEL_JOIN {self.current_channel}")
+        channel = ' '.join(parts[2:]).strip()
+        # Anything still pending belongs to the channel we just left
+        self.presence.clear()
+        key = channel.lower()
+        state = self.channels.get(key)
+        if state is None:
+            state = self.channels[key] = ChannelState(channel)
+            # Forget the channels left longest ago; the one just joined is never the oldest
+            while len(self.channels) > self.max_channels:
+                self.channels.popitem(last=False)
+        else:
+            self.channels.move_to_end(key)
+        self.channel = state
+        # The UI routes everything after this line to the channel's own view
+        self.log_callback(f"CHANNEL_JOIN {channel}")
+        if len(state.roster):
+            # Back in a channel we know, e.g. after a reconnect: keep its roster and
+            # reconcile it against the user list the server is about to send. The
+            # channel's view may have been closed meanwhile, so send it all again.
+            self.stale = set(state.roster.names())
+            self.listing = asyncio.get_running_loop().call_later(self.list_settle, self.end_listing)
+            if self.ui_callback is not None:
+                self.ui_callback(state.roster.snapshot())
+        else:
+            self.stale = None
+            self.end_listing()
+            if self.ui_callback is not None:
+                self.ui_callback([state.roster.clear()])
 
     async def queue_user_message(self, parts):
-        """Queue user-related messages for batch processing."""
-        self.user_message_queue.append(parts)
+        """Fold a USER IN/JOIN/UPDATE/LEAVE into the current presence window."""
+        if parts[1] == "LEAVE":
+            if len(parts) < 7:
+                return
+            self.presence.leave(parts[6])
+        else:
+            if len(parts) < 8:
+                return
+            self.presence.update(parts[1], parts[6], parts[4], parts[5], parts[7])
+            if self.listing is not None:
+                # Still listing; only reconcile once list_settle passes without another USER IN
+                self.listing.cancel()
+                self.listing = asyncio.get_running_loop().call_later(self.list_settle, self.end_listing)
         if self.batch_task is None or self.batch_task.done():
             self.batch_task = asyncio.create_task(self.process_user_message_batch())
 
+    def end_listing(self):
+        """The server is done relisting the channel; have the next batch drop whoever it left out."""
+        if self.listing is None:
+            return
+        self.listing.cancel()
+        self.listing = None
+        if self.stale is not None and (self.batch_task is None or self.batch_task.done()):
+            self.batch_task = asyncio.create_task(self.process_user_message_batch())
+
     async def process_user_message_batch(self):
-        """Process queued user messages after a delay, preserving server order and logging in sequence."""
-        await asyncio.sleep(self.batch_delay)
-        users_to_add = []
-        users_to_update = []
-        users_to_remove = set()
-        updated_usernames = set()
-
-        while self.user_message_queue:
-            parts = self.user_message_queue.popleft()
-            msg_subtype = parts[1]
-
-            if msg_subtype in ("IN", "JOIN", "UPDATE"):
-                if len(parts) < 8:
-                    continue
-                flags = parts[4]
-                ping = parts[5]
-                username = parts[6]
-                stats = parts[7]
-                user = User(name=username, flags=flags, ping=ping, stats=stats)
-
-                if msg_subtype == "UPDATE":
-                    users_to_update.append(user)
-                    updated_usernames.add(username)
-                elif msg_subtype == "JOIN" and username not in updated_usernames:
-                    # Only show join/leave if the last one was greater than x seconds ago
-                    if time.time() - self.last_join_msg > 3:
-                        self.log_callback(f"User join {username}")
-                        self.last_join_msg = time.time()
-                    users_to_add.append(user)
-                elif msg_subtype == "IN" and username not in updated_usernames:
-                    users_to_add.append(user)
-
-            elif msg_subtype == "LEAVE":
-                if len(parts) < 7:
+        """Apply each user's net change from the window to the roster and push the deltas to the UI."""
+        await asyncio.sleep(self.presence.window())
+        events, changes = self.presence.drain()
+        self.batch_sizes.observe(events)
+        self.presence_coalesced.inc(events - len(changes))
+        roster = self.roster
+        stale = self.stale
+        deltas = []
+        joined = []
+        left = []
+        passed = []
+
+        for presence in changes:
+            username = presence.name
+            entry = roster.get(username)
+            if presence.present:
+                if stale is not None:
+                    stale.discard(username)
+                if entry is None:
+                    if presence.joined:
+                        joined.append(username)
+                elif (entry.flags, entry.ping, entry.stats) == (presence.flags, presence.ping, presence.stats):
                     continue
-                username = parts[6]
-                users_to_remove.add(username)
-                # Only show join/leave if the last one was greater than x seconds ago
-                if time.time() - self.last_leave_msg > 3:
-                    self.log_callback(f"User leave {username}")
-                    self.last_leave_msg = time.time()
-
-        # Remove users
-        self.channel_users = [u for u in self.channel_users if u.name not in users_to_remove]
-
-        # Update existing users
-        for user in users_to_update:
-            for i, existing_user in enumerate(self.channel_users):
-                if existing_user.name == user.name:
-                    self.channel_users[i] = user
-                    break
-
-        # Add new users to end
-        for user in users_to_add:
-            if user.name not in [u.name for u in self.channel_users]:
-                self.channel_users.append(user)
-
-        # Update UI once with the final user list
-        if self.ui_callback is not None and (users_to_add or users_to_remove or users_to_update):
-            self.ui_callback(self.channel_users)
+                deltas.append(roster.add(username, presence.flags, presence.ping, presence.stats))
+            elif entry is not None:
+                deltas.append(roster.remove(username))
+                left.append(username)
+            elif presence.joined:
+                # Joined and left again inside the window; the roster never sees them
+                passed.append(username)
+
+        if stale is not None and self.listing is None:
+            # Whoever the server did not list again left while we were away
+            for username in stale:
+                removed = roster.remove(username)
+                if removed is not None:
+                    deltas.append(removed)
+            self.stale = None
+
+        summary = summarize(joined, left, passed)
+        if summary is not None:
+            self.log_callback(summary)
+
+        # Update UI once with every change from this batch
+        if self.ui_callback is not None and deltas:
+            self.ui_callback(deltas)
+
+    def record_history(self, kind, username, text):
+        if self.history is not None:
+            self.history.record(kind, self.current_channel, username, text)
 
     async def handle_user_talk(self, parts):
         if len(parts) < 7:
             return
         username = parts[6]
         msg = ' '.join(parts[7:])
-        self.log_callback(f"{username}: {msg}")
+        self.record_history("talk", username, msg)
+        # Under overload channel chat is only sampled for display; it is still recorded and triggers still run
+        if self.overload is None or self.overload.admit_chat():
+            self.log_callback(f"{username}: {msg}")
+        if self.triggers is not None:
+            self.fire_triggers(username, msg, False)
 
     async def handle_user_whisper(self, parts):
         if len(parts) < 7:
             return
         username = parts[6]
         msg = ' '.join(parts[7:])
-        self.log_callback(f"{username}: {msg}")
\ No newline at end of file
+        self.record_history("whisper", username, msg)
+        self.log_callback(f"{username}: {msg}")
+        if self.triggers is not None:
+            self.fire_triggers(username, msg, True)
+
+    def fire_triggers(self, username, msg, whisper):
+        # A broken trigger must never take the connection down with it
+        try:
+            self.triggers.dispatch(self.current_channel, username, msg, whisper=whisper)
+        except Exception:
+            logger.exception("Trigger dispatch failed for %r", msg)
\ No newline at end of file
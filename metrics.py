@@ -0,0 +1,250 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as Tally
+
+# Bucket upper bounds: 1-2-5 steps from 1us to 10s for latencies, 1 to 100k for sizes
+LATENCY_BOUNDS = tuple(m * 10 ** e for e in range(-6, 1) for m in (1, 2, 5)) + (10.0,)
+SIZE_BOUNDS = tuple(m * 10 ** e for e in range(0, 5) for m in (1, 2, 5)) + (100000,)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and two adds."""
+
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile, capped at the max seen."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class Registry:
+    """Named counters, histograms and gauges for the client pipeline."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.monotonic()
+        self.last_snapshot = (self.started, {})
+
+    def counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = Counter()
+        return counter
+
+    def histogram(self, name, bounds=LATENCY_BOUNDS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(bounds)
+        return histogram
+
+    def gauge(self, name, read):
+        """Register a callable sampled at snapshot time."""
+        if not callable(read):
+            raise ValueError("gauge must be callable")
+        self.gauges[name] = read
+
+    def snapshot(self):
+        """Current values, with per-second counter rates since the previous snapshot."""
+        now = time.monotonic()
+        last_time, last_values = self.last_snapshot
+        elapsed = now - last_time
+        values = {name: counter.value for name, counter in self.counters.items()}
+        rates = {
+            name: (value - last_values.get(name, 0)) / elapsed if elapsed > 0 else 0.0
+            for name, value in values.items()
+        }
+        self.last_snapshot = (now, values)
+        gauges = {}
+        for name, read in self.gauges.items():
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {
+            "uptime": now - self.started,
+            "counters": values,
+            "rates": rates,
+            "gauges": gauges,
+            "histograms": {name: h.snapshot() for name, h in self.histograms.items()},
+        }
+
+    def to_text(self, snapshot=None):
+        snapshot = snapshot if snapshot is not None else self.snapshot()
+        lines = [f"uptime {snapshot['uptime']:.3f}"]
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"{name} {value} ({snapshot['rates'][name]:.1f}/s)")
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append(f"{name} {value}")
+        for name, h in sorted(snapshot["histograms"].items()):
+            fields = " ".join(f"{key}={value:.6g}" for key, value in h.items())
+            lines.append(f"{name} {fields}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry used by the client, handler and UI instrumentation
+registry = Registry()
+
+
+class MetricsServer:
+    """Tiny local HTTP endpoint: /metrics for text, /metrics.json for JSON."""
+
+    def __init__(self, registry=registry, host="127.0.0.1", port=0):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        try:
+            request = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()).strip():
+                pass
+            path = request[1] if len(request) > 1 else "/"
+            if path == "/metrics.json":
+                body, content_type = json.dumps(self.registry.snapshot()), "application/json"
+                status = "200 OK"
+            elif path in ("/", "/metrics"):
+                body, content_type = self.registry.to_text(), "text/plain"
+                status = "200 OK"
+            else:
+                body, content_type, status = "not found\n", "text/plain", "404 Not Found"
+            data = body.encode("utf-8")
+            writer.write(
+                f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(data)}\r\n\r\n".encode("latin-1")
+                + data
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def dump_periodically(interval, path=None, registry=registry):
+    """Append a JSON snapshot to path (or print the text form) every interval seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        snapshot = registry.snapshot()
+        if path:
+            with open(path, "a") as out:
+                out.write(json.dumps(snapshot) + "\n")
+        else:
+            print(registry.to_text(snapshot), end="")
+
+
+class SamplingProfiler:
+    """Opt-in statistical profiler for one thread, usually the event loop's.
+
+    A background thread samples the target thread's stack every interval
+    seconds and tallies the innermost frames, so the cost is bounded by the
+    sample rate rather than by how much code runs.
+    """
+
+    def __init__(self, thread_id, interval=0.005, depth=8):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.depth = depth
+        self.samples = Tally()
+        self.total = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="pchat-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno}({code.co_name})")
+                    frame = frame.f_back
+                self.samples[tuple(stack)] += 1
+                self.total += 1
+            time.sleep(self.interval)
+
+    def report(self, top=20):
+        lines = [f"{self.total} samples"]
+        for stack, count in self.samples.most_common(top):
+            lines.append(f"{count:6d} {100 * count / max(1, self.total):5.1f}%  " + " <- ".join(stack))
+        return "\n".join(lines)
+
+
+async def start_exporters(config, registry=registry):
+    """Start whichever exporters config asks for; returns things to stop later."""
+    started = []
+    if config.get('metrics_port') is not None:
+        server = MetricsServer(registry, port=config['metrics_port'])
+        await server.start()
+        started.append(server)
+    if config.get('metrics_dump_interval'):
+        started.append(asyncio.create_task(
+            dump_periodically(config['metrics_dump_interval'], config.get('metrics_dump_file'), registry)
+        ))
+    return started
@@ -0,0 +1,100 @@
+import asyncio
+import concurrent.futures
+from log_setup import get_logger
+from metrics import registry
+
+logger = get_logger("offload")
+
+
+class OffloadBusy(Exception):
+    """Raised when the offload queue is full and the caller asked not to wait."""
+
+
+class Offloader:
+    """Runs CPU-heavy functions off the event loop, in threads or processes.
+
+    At most max_pending calls are queued or running at once. Callers over the
+    limit either wait for a slot (run) or are turned away (run_nowait), so a
+    burst of expensive work can never pile up without bound. Functions sent
+    to a process pool must be picklable module-level functions.
+    """
+
+    def __init__(self, mode="thread", workers=None, max_pending=64):
+        self.check(mode, workers, max_pending)
+        self.mode = mode
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.slots = None
+        self.executor = None
+        self.submitted = registry.counter("offload_submitted")
+        self.rejected = registry.counter("offload_rejected")
+        self.cancelled = registry.counter("offload_cancelled")
+        self.run_time = registry.histogram("offload_seconds")
+        registry.gauge("offload_pending", lambda: self.pending)
+
+    @staticmethod
+    def check(mode="thread", workers=None, max_pending=64):
+        """Raise ValueError for settings the constructor would reject, without creating anything."""
+        if mode not in ("thread", "process"):
+            raise ValueError(f"unknown offload mode {mode!r}")
+        if workers is not None and workers < 1:
+            raise ValueError("workers must be at least 1")
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1")
+
+    @classmethod
+    def from_config(cls, settings):
+        try:
+            return cls(**(settings or {}))
+        except TypeError as e:
+            raise ValueError(f"bad offload setting: {e}") from None
+
+    def start(self):
+        if self.executor is None:
+            if self.mode == "process":
+                self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+            else:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="pchat-offload")
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_pending)
+        return self.executor
+
+    @property
+    def saturated(self):
+        return self.pending >= self.max_pending
+
+    async def run(self, func, *args):
+        """Run func(*args) in the pool, waiting for a free slot first."""
+        executor = self.start()
+        async with self.slots:
+            return await self.execute(executor, func, args)
+
+    async def run_nowait(self, func, *args):
+        """Like run, but raise OffloadBusy instead of waiting when the queue is full."""
+        if self.saturated:
+            self.rejected.inc()
+            raise OffloadBusy(f"{self.pending} offloaded calls already pending")
+        return await self.run(func, *args)
+
+    async def execute(self, executor, func, args):
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        self.submitted.inc()
+        start = loop.time()
+        future = loop.run_in_executor(executor, func, *args)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # Only calls still waiting in the pool can be withdrawn; running ones finish unobserved
+            self.cancelled.inc()
+            raise
+        finally:
+            self.pending -= 1
+            self.run_time.observe(loop.time() - start)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.slots = None
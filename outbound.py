@@ -0,0 +1,202 @@
+import asyncio
+import time
+from collections import deque
+from log_setup import get_logger
+from metrics import registry
+
+logger = get_logger("outbound")
+
+# Priority classes, highest first
+PRIORITY_CONTROL = 0
+PRIORITY_MODERATION = 1
+PRIORITY_CHAT = 2
+
+MODERATION_COMMANDS = frozenset({
+    "/kick", "/ban", "/unban", "/op", "/deop", "/designate", "/resign",
+    "/squelch", "/unsquelch", "/ignore", "/unignore", "/topic",
+})
+WHISPER_COMMANDS = frozenset({"/w", "/whisper", "/m", "/msg"})
+
+COALESCE_SEPARATOR = " | "
+
+
+def classify(command):
+    """Pick the priority class for an outgoing command."""
+    head = command.partition(" ")[0].lower()
+    if head in MODERATION_COMMANDS:
+        return PRIORITY_MODERATION
+    return PRIORITY_CHAT
+
+
+def split_target(command):
+    """Return (target key, prefix, body) for chat and whispers, or None.
+
+    Plain channel chat has an empty prefix. Commands other than whispers are
+    never coalesced.
+    """
+    if not command.startswith("/"):
+        return ("channel", "", command)
+    head, _, rest = command.partition(" ")
+    if head.lower() in WHISPER_COMMANDS:
+        name, _, body = rest.partition(" ")
+        if name and body:
+            return (name.lower(), f"{head} {name} ", body)
+    return None
+
+
+class TokenBucket:
+    """Classic token bucket: rate tokens per second, up to burst tokens."""
+
+    def __init__(self, rate, burst):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """Seconds until the next token is available."""
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class OutboundItem:
+    __slots__ = ("text", "queued_at", "target")
+
+    def __init__(self, text, queued_at, target):
+        self.text = text
+        self.queued_at = queued_at
+        self.target = target
+
+
+class OutboundScheduler:
+    """Rate-limited, prioritized writer for everything sent to the server.
+
+    Control traffic (login, PONG) bypasses the token bucket and always goes
+    first; moderation commands go before chat. Each tick writes all sendable
+    lines with a single writer.write. With coalesce=True, chat lines or
+    whispers for the same target that are held back by the rate limit are
+    merged while they wait; that changes what the bot says, so it is off
+    unless asked for.
+    """
+
+    def __init__(self, rate=2.0, burst=5, max_line=200, coalesce=False, max_queued=500):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_line = max_line
+        self.coalesce = coalesce
+        # Chat and moderation queues are bounded; control traffic never is
+        self.max_queued = max_queued
+        self.queues = (deque(), deque(), deque())
+        self.wakeup = asyncio.Event()
+
+        # Metrics
+        self.sent = 0
+        self.coalesced = 0
+        self.writes = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.avg_latency = 0.0
+        self.dropped = registry.counter("outbound_dropped")
+        self.latency_histogram = registry.histogram("send_latency_seconds")
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues)
+
+    def reset(self):
+        """Forget control traffic meant for a connection that is gone."""
+        self.queues[PRIORITY_CONTROL].clear()
+
+    def enqueue(self, command, priority=None):
+        """Queue a command; must be called on the event loop thread."""
+        if priority is None:
+            priority = classify(command)
+        queue = self.queues[priority]
+        target = None
+        if priority == PRIORITY_CHAT and self.coalesce:
+            target = split_target(command)
+            # Only merge once lines are actually waiting on the rate limit
+            if target is not None and queue:
+                self.bucket.refill()
+            if target is not None and queue and len(queue) >= self.bucket.tokens:
+                last = queue[-1]
+                if last.target is not None and last.target[0] == target[0]:
+                    merged = last.text + COALESCE_SEPARATOR + target[2]
+                    if len(merged) <= self.max_line:
+                        last.text = merged
+                        self.coalesced += 1
+                        return
+        if priority != PRIORITY_CONTROL and len(queue) >= self.max_queued:
+            self.dropped.inc()
+            logger.debug("Outbound queue full, dropping: %s", command)
+            return
+        queue.append(OutboundItem(command, time.monotonic(), target))
+        self.wakeup.set()
+
+    def take_batch(self):
+        """Pop every line that may be sent right now, highest priority first."""
+        batch = []
+        control = self.queues[PRIORITY_CONTROL]
+        while control:
+            batch.append(control.popleft())
+        for queue in self.queues[PRIORITY_CONTROL + 1:]:
+            while queue and self.bucket.take():
+                batch.append(queue.popleft())
+        return batch
+
+    def record(self, batch, now):
+        for item in batch:
+            latency = now - item.queued_at
+            self.latency_histogram.observe(latency)
+            self.avg_latency += (latency - self.avg_latency) * 0.1
+            if latency > self.max_latency:
+                self.max_latency = latency
+        self.last_latency = latency
+        self.sent += len(batch)
+        self.writes += 1
+
+    async def run(self, writer):
+        """Write queued commands to writer until cancelled."""
+        while True:
+            batch = self.take_batch()
+            if batch:
+                try:
+                    writer.write("".join(f"{item.text}\r\n" for item in batch).encode('utf-8'))
+                    self.record(batch, time.monotonic())
+                    await writer.drain()
+                except (ConnectionError, OSError) as e:
+                    logger.warning("Send error: %s", e)
+                    return
+
+            self.wakeup.clear()
+            if self.queues[PRIORITY_CONTROL]:
+                continue
+            # Anything still queued is waiting on the token bucket
+            timeout = self.bucket.delay() if len(self) else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        return {
+            "queued": [len(q) for q in self.queues],
+            "sent": self.sent,
+            "writes": self.writes,
+            "coalesced": self.coalesced,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "avg_latency": self.avg_latency,
+        }
@@ -0,0 +1,123 @@
+import asyncio
+import time
+import weakref
+from log_setup import get_logger
+from metrics import registry
+
+logger = get_logger("overload")
+
+MODES = ("sample", "drop", "off")
+
+# Every live guard, so the backlog gauge covers all sessions in a pool
+GUARDS = weakref.WeakSet()
+
+
+class OverloadGuard:
+    """Watches the backlog behind a client and sheds display work when it grows.
+
+    The backlog is the sum of every watched depth (UI queue, history queue,
+    trigger tasks). Crossing high puts the guard into overload: socket reads
+    pause until the backlog falls back to low, and channel chat is only
+    sampled for display (one line in sample, or none in "drop" mode, and
+    none at all once the backlog reaches limit) for at least hold seconds,
+    so a consumer hovering around high does not flap in and out. Below
+    limit a pause never lasts longer than max_pause, so PINGs keep being
+    read and answered however long the overload goes on; at limit or above,
+    reads stay paused until the backlog drops under it, since reading more
+    could only grow it (each read still answers its PINGs first). PINGs,
+    roster changes and whispers are never shed.
+    """
+
+    def __init__(self, high=10000, low=2000, mode="sample", sample=10, max_pause=1.0, hold=2.0, limit=None,
+                 poll=0.02):
+        if mode not in MODES:
+            raise ValueError(f"unknown overload mode {mode!r}, expected one of {', '.join(MODES)}")
+        if not 0 <= low < high:
+            raise ValueError("need 0 <= low < high")
+        if sample < 1:
+            raise ValueError("sample must be at least 1")
+        self.high = high
+        self.low = low
+        self.mode = mode
+        self.sample = sample
+        self.max_pause = max_pause
+        self.hold = hold
+        self.limit = limit if limit is not None else high * 4
+        self.poll = poll
+        self.sources = []
+        self.report = None
+        self.overloaded = False
+        self.since = 0.0
+        self.seen = 0
+        self.shed = 0
+        self.events = registry.counter("overload_events")
+        self.chat_shed = registry.counter("overload_chat_shed")
+        self.read_pauses = registry.counter("overload_read_pauses")
+        self.pause_time = registry.histogram("overload_pause_seconds")
+        GUARDS.add(self)
+        registry.gauge("overload_backlog", lambda: sum(guard.depth() for guard in list(GUARDS)))
+
+    @classmethod
+    def from_config(cls, settings):
+        try:
+            return cls(**(settings or {}))
+        except TypeError as e:
+            raise ValueError(f"bad overload setting: {e}") from None
+
+    def watch(self, depth):
+        """Count depth() towards the backlog; depth must be cheap and safe to call from the loop thread."""
+        if not callable(depth):
+            raise ValueError("depth must be callable")
+        self.sources.append(depth)
+
+    def depth(self):
+        return sum(depth() for depth in self.sources)
+
+    def check(self):
+        """Update the overload state from the current backlog and return it."""
+        if self.mode == "off":
+            return False
+        depth = self.depth()
+        if not self.overloaded and depth >= self.high:
+            self.overloaded = True
+            self.since = time.monotonic()
+            self.seen = self.shed = 0
+            self.events.inc()
+            self.notify(f"Overloaded: {depth} events backed up, "
+                        f"{'sampling' if self.mode == 'sample' else 'dropping'} channel chat")
+        elif self.overloaded and depth <= self.low and time.monotonic() - self.since >= self.hold:
+            self.overloaded = False
+            self.notify(f"Recovered from overload after {time.monotonic() - self.since:.1f}s, "
+                        f"{self.shed} chat lines not shown")
+        return self.overloaded
+
+    def notify(self, message):
+        logger.warning("%s", message)
+        if self.report is not None:
+            self.report(message)
+
+    def admit_chat(self):
+        """Whether a channel chat line should be displayed."""
+        # Checked per line too, so an overload that starts inside one large read takes effect at once
+        if not self.check():
+            return True
+        self.seen += 1
+        if self.mode == "sample" and (self.seen - 1) % self.sample == 0 and self.depth() < self.limit:
+            return True
+        self.shed += 1
+        self.chat_shed.inc()
+        return False
+
+    async def wait(self):
+        """Hold off the next socket read while overloaded, for at most max_pause seconds."""
+        if not self.check() or self.depth() <= self.low:
+            return
+        self.read_pauses.inc()
+        start = time.monotonic()
+        deadline = start + self.max_pause
+        while True:
+            depth = self.depth()
+            if depth <= self.low or (depth < self.limit and time.monotonic() >= deadline):
+                break
+            await asyncio.sleep(self.poll)
+        self.pause_time.observe(time.monotonic() - start)
@@ -0,0 +1,106 @@
+import time
+
+
+class Presence:
+    """Where one user ended up after every event seen for them in the current window."""
+
+    __slots__ = ("name", "present", "joined", "flags", "ping", "stats")
+
+    def __init__(self, name):
+        self.name = name
+        self.present = False
+        self.joined = False
+        self.flags = None
+        self.ping = None
+        self.stats = None
+
+
+class PresenceEngine:
+    """Coalesces USER IN/JOIN/UPDATE/LEAVE into one net change per user.
+
+    Events are collected for a window whose length follows the incoming
+    rate: min_window when the channel is quiet, growing towards max_window
+    as the rate approaches storm_rate events per second. Within a window a
+    JOIN followed by a LEAVE cancels out and repeated UPDATEs collapse to
+    the last one, so a netsplit costs one roster pass instead of thousands.
+    """
+
+    def __init__(self, min_window=0.05, max_window=1.0, storm_rate=2000.0):
+        if min_window < 0 or max_window < min_window:
+            raise ValueError("need 0 <= min_window <= max_window")
+        self.min_window = min_window
+        self.max_window = max_window
+        self.storm_rate = storm_rate
+        self.pending = {}
+        self.events = 0
+        self.rate = 0.0
+        self.started = self.last_drain = time.monotonic()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def entry(self, name):
+        presence = self.pending.get(name)
+        if presence is None:
+            if not self.pending:
+                self.started = time.monotonic()
+                if self.started - self.last_drain > self.max_window:
+                    # First event after a quiet spell: start over with a short window
+                    self.rate = 0.0
+            presence = self.pending[name] = Presence(name)
+        self.events += 1
+        return presence
+
+    def update(self, subtype, name, flags, ping, stats):
+        """Record a USER IN, JOIN or UPDATE."""
+        presence = self.entry(name)
+        presence.present = True
+        if subtype == "JOIN":
+            presence.joined = True
+        presence.flags = flags
+        presence.ping = ping
+        presence.stats = stats
+
+    def leave(self, name):
+        """Record a USER LEAVE."""
+        self.entry(name).present = False
+
+    def window(self):
+        """How long to keep collecting before the next drain."""
+        if self.storm_rate <= 0:
+            return self.max_window
+        scaled = self.max_window * self.rate / self.storm_rate
+        return min(self.max_window, max(self.min_window, scaled))
+
+    def drain(self):
+        """Return (event count, net Presence list in first-seen order) and start a new window."""
+        now = time.monotonic()
+        elapsed = max(now - self.started, self.min_window, 1e-6)
+        observed = self.events / elapsed
+        self.rate = observed if not self.rate else (self.rate + observed) / 2
+        changes = list(self.pending.values())
+        events = self.events
+        self.pending = {}
+        self.events = 0
+        self.last_drain = now
+        return events, changes
+
+    def clear(self):
+        self.pending = {}
+        self.events = 0
+
+
+def summarize(joined, left, passed):
+    """One log line for a window of presence changes, or None if nobody came or went."""
+    if len(joined) == 1 and not left and not passed:
+        return f"User join {joined[0]}"
+    if len(left) == 1 and not joined and not passed:
+        return f"User leave {left[0]}"
+    fields = []
+    if joined:
+        fields.append(f"{len(joined)} joined")
+    if left:
+        fields.append(f"{len(left)} left")
+    if passed:
+        fields.append(f"{len(passed)} joined and left")
+    return ", ".join(fields) if fields else None
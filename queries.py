@@ -0,0 +1,254 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict, deque
+from dispatch import STOP
+from log_setup import get_logger
+from metrics import registry
+
+logger = get_logger("queries")
+
+
+class QueryTimeout(Exception):
+    """Raised when the server does not answer a query in time."""
+
+
+class QuerySpec:
+    """How to ask one kind of question and recognize the answer.
+
+    command is formatted with the target. Each reply is (msg_type, subtype,
+    pattern, final): a matching SERVER line becomes part of the answer, and
+    the answer is complete after a final one. Patterns with a user group
+    only match replies about the queried user; the named groups of every
+    matched line are merged into the result.
+    """
+
+    def __init__(self, name, command, replies, settle=0.25):
+        self.name = name
+        self.command = command
+        self.replies = [(msg_type, subtype, re.compile(pattern), final)
+                        for msg_type, subtype, pattern, final in replies]
+        # How long to wait for more lines once a non-final reply matched
+        self.settle = settle
+
+    def match(self, msg_type, subtype, text, target):
+        for reply_type, reply_subtype, pattern, final in self.replies:
+            if reply_type != msg_type or reply_subtype != subtype:
+                continue
+            match = pattern.match(text)
+            if match is None:
+                continue
+            user = match.groupdict().get("user")
+            if user is not None and user.lower() != target.lower():
+                continue
+            return match, final
+        return None
+
+
+WHOIS_REPLIES = (
+    ("SERVER", "INFO", r"(?P<user>\S+) is using (?P<product>.+?) in (?:the channel (?P<channel>.+)|"
+                       r"(?P<private>a private channel)|the game (?P<game>.+))\.$", True),
+    ("SERVER", "ERROR", r"(?P<offline>That user is not logged on)\.$", True),
+    ("SERVER", "INFO", r"(?P<offline>User was last seen on: (?P<last_seen>.+))$", True),
+)
+
+SPECS = {
+    "whois": QuerySpec("whois", "/whois {target}", WHOIS_REPLIES),
+    "where": QuerySpec("where", "/where {target}", WHOIS_REPLIES),
+    "stats": QuerySpec("stats", "/stats {target}", (
+        ("SERVER", "INFO", r"(?P<user>\S+)'s record:$", False),
+        ("SERVER", "INFO", r"Normal games: (?P<normal>.+)$", False),
+        ("SERVER", "INFO", r"Ladder games: (?P<ladder>.+)$", False),
+        ("SERVER", "INFO", r"IronMan games: (?P<ironman>.+)$", True),
+        ("SERVER", "ERROR", r"(?P<offline>That user is not logged on)\.$", True),
+    )),
+}
+
+
+class Query:
+    __slots__ = ("spec", "target", "key", "future", "result", "lines", "sent_at", "settle_handle", "visible",
+                 "expiry")
+
+    def __init__(self, spec, target, key, future, visible=False):
+        self.spec = spec
+        self.target = target
+        self.key = key
+        self.future = future
+        self.result = {}
+        self.lines = []
+        self.sent_at = time.monotonic()
+        self.settle_handle = None
+        # Asked by hand: the answer is still shown, and nobody waits on it
+        self.visible = visible
+        self.expiry = None
+
+
+class QueryEngine:
+    """Awaitable server queries, answered from a TTL/LRU cache when possible.
+
+    The server answers commands in the order they were sent, with plain
+    SERVER INFO/ERROR lines. Outstanding queries are kept in that order and
+    each such line goes to the oldest one whose spec matches it; those lines
+    are consumed instead of logged. A query already in flight is shared by
+    everyone asking the same thing, answers are cached for ttl seconds
+    (max_entries most recently used), and a USER UPDATE or LEAVE for a user
+    drops what was cached about them. Asking something that is neither
+    cached nor in flight while connected() is false raises ConnectionError
+    at once, since no answer could arrive.
+
+    send must queue the command synchronously. Commands the user types go
+    through track(), so their answers keep their place in the order; those
+    answers are shown as usual rather than consumed.
+    """
+
+    def __init__(self, send, timeout=5.0, ttl=60.0, max_entries=1024, specs=None, connected=None):
+        if ttl < 0 or max_entries < 1:
+            raise ValueError("need ttl >= 0 and max_entries >= 1")
+        self.send = send
+        self.connected = connected
+        self.timeout = timeout
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.specs = dict(SPECS if specs is None else specs)
+        self.verbs = {spec.command.split()[0].lower(): spec for spec in self.specs.values()}
+        self.pending = deque()
+        self.in_flight = {}
+        self.cache = OrderedDict()
+        self.sent = registry.counter("query_sent")
+        self.hits = registry.counter("query_cache_hits")
+        self.shared = registry.counter("query_coalesced")
+        self.timeouts = registry.counter("query_timeouts")
+        self.invalidated = registry.counter("query_invalidated")
+        self.latency = registry.histogram("query_seconds")
+
+    def register(self, spec):
+        self.specs[spec.name] = spec
+        self.verbs[spec.command.split()[0].lower()] = spec
+
+    def attach(self, dispatch):
+        """Subscribe on a DispatchRegistry, ahead of the built-in handlers."""
+        for subtype in ("INFO", "ERROR"):
+            dispatch.subscribe("SERVER", subtype, self.on_server, priority=-10)
+        for subtype in ("UPDATE", "LEAVE"):
+            dispatch.subscribe("USER", subtype, self.on_user_change, priority=-10)
+
+    async def query(self, kind, target, fresh=False):
+        """The answer to a kind query about target, as a dict of the reply fields plus "lines"."""
+        spec = self.specs.get(kind)
+        if spec is None:
+            raise ValueError(f"unknown query {kind!r}")
+        key = (kind, target.lower())
+        if not fresh:
+            cached = self.cache.get(key)
+            if cached is not None:
+                expires, result = cached
+                if expires > time.monotonic():
+                    self.cache.move_to_end(key)
+                    self.hits.inc()
+                    return result
+                del self.cache[key]
+        query = self.in_flight.get(key)
+        if query is not None:
+            self.shared.inc()
+        elif self.connected is not None and not self.connected():
+            raise ConnectionError(f"not connected, cannot send {spec.command.format(target=target)}")
+        else:
+            query = self.start(spec, target, key)
+        try:
+            # Shielded so one caller giving up does not cancel the answer for the others
+            return await asyncio.wait_for(asyncio.shield(query.future), self.timeout)
+        except asyncio.TimeoutError:
+            if self.in_flight.get(key) is query:
+                logger.debug("No answer to %s query about %s after %ss", kind, target, self.timeout)
+                self.timeouts.inc()
+                self.finish(query, error=QueryTimeout(f"no answer to {spec.command.format(target=target)}"))
+            raise QueryTimeout(f"no answer to {spec.command.format(target=target)}") from None
+
+    def start(self, spec, target, key):
+        query = Query(spec, target, key, asyncio.get_running_loop().create_future())
+        # Nobody may be left waiting when it fails, so never log it as unretrieved
+        query.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.in_flight[key] = query
+        self.pending.append(query)
+        self.sent.inc()
+        self.send(spec.command.format(target=target))
+        return query
+
+    def track(self, command):
+        """Note a command about to be sent some other way; if it asks a known question, expect its answer."""
+        if not command.startswith("/") or not self.verbs:
+            return
+        words = command.split()
+        spec = self.verbs.get(words[0].lower())
+        if spec is None or len(words) < 2 or (self.connected is not None and not self.connected()):
+            return
+        target = words[1]
+        loop = asyncio.get_running_loop()
+        query = Query(spec, target, (spec.name, target.lower()), loop.create_future(), visible=True)
+        query.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        query.expiry = loop.call_later(self.timeout, self.finish, query,
+                                       QueryTimeout(f"no answer to {command}"))
+        self.pending.append(query)
+
+    def finish(self, query, error=None):
+        if query.settle_handle is not None:
+            query.settle_handle.cancel()
+            query.settle_handle = None
+        if query.expiry is not None:
+            query.expiry.cancel()
+            query.expiry = None
+        if self.in_flight.get(query.key) is query:
+            del self.in_flight[query.key]
+        try:
+            self.pending.remove(query)
+        except ValueError:
+            pass
+        if query.future.done():
+            return
+        if error is not None:
+            query.future.set_exception(error)
+            return
+        result = dict(query.result, lines=query.lines)
+        self.latency.observe(time.monotonic() - query.sent_at)
+        if self.ttl:
+            self.cache[query.key] = (time.monotonic() + self.ttl, result)
+            self.cache.move_to_end(query.key)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        query.future.set_result(result)
+
+    def on_server(self, parts):
+        if not self.pending:
+            return None
+        text = parts[2].strip() if len(parts) > 2 else ""
+        for query in self.pending:
+            matched = query.spec.match(parts[0], parts[1], text, query.target)
+            if matched is None:
+                continue
+            match, final = matched
+            query.result.update((k, v) for k, v in match.groupdict().items() if v is not None)
+            query.lines.append(text)
+            if final:
+                self.finish(query)
+            else:
+                if query.settle_handle is not None:
+                    query.settle_handle.cancel()
+                query.settle_handle = asyncio.get_running_loop().call_later(query.spec.settle, self.finish, query)
+            return None if query.visible else STOP
+        return None
+
+    def on_user_change(self, parts):
+        if len(parts) > 6 and self.cache:
+            self.invalidate(parts[6])
+
+    def invalidate(self, user):
+        """Forget every cached answer about user."""
+        user = user.lower()
+        for kind in self.specs:
+            if self.cache.pop((kind, user), None) is not None:
+                self.invalidated.inc()
+
+    def fail_pending(self, error):
+        """Fail every outstanding query, e.g. when the connection drops."""
+        for query in list(self.pending):
+            self.finish(query, error=error)
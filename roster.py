@@ -0,0 +1,129 @@
+from collections import namedtuple
+
+OPERATOR_FLAGS = "18"
+
+# Roster change events. Indices are display positions (operators first) after
+# the change has been applied; UserUpdated.index is None unless the user moved.
+UserAdded = namedtuple("UserAdded", ["name", "flags", "ping", "stats", "index"])
+UserUpdated = namedtuple("UserUpdated", ["name", "flags", "ping", "stats", "index"])
+UserRemoved = namedtuple("UserRemoved", ["name"])
+RosterCleared = namedtuple("RosterCleared", [])
+
+
+class RosterEntry:
+    """A single user in the channel roster."""
+
+    __slots__ = ("name", "flags", "ping", "stats")
+
+    def __init__(self, name, flags, ping, stats):
+        self.name = name
+        self.flags = flags
+        self.ping = ping
+        self.stats = stats
+
+    @property
+    def is_operator(self):
+        return self.flags == OPERATOR_FLAGS
+
+    def __repr__(self):
+        return f"RosterEntry(name={self.name!r}, flags={self.flags!r}, ping={self.ping!r}, stats={self.stats!r})"
+
+
+class Roster:
+    """Channel user list keyed by username.
+
+    Entries are kept in server order, with operators and non-operators held in
+    separate partitions so the display order (operators first) never has to be
+    recomputed. Lookup, insert, update and remove are all O(1). A user whose
+    operator status changes moves to the end of the other partition.
+
+    Mutating methods return the delta event describing the change so callers
+    can forward it to views without diffing the whole list.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._operators = {}
+        self._others = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __iter__(self):
+        """Iterate entries in display order: operators first, then everyone else."""
+        yield from self._operators.values()
+        yield from self._others.values()
+
+    def get(self, name, default=None):
+        return self._entries.get(name, default)
+
+    def names(self):
+        return self._entries.keys()
+
+    def in_server_order(self):
+        return iter(self._entries.values())
+
+    def operators(self):
+        return iter(self._operators.values())
+
+    def others(self):
+        return iter(self._others.values())
+
+    def _partition(self, entry):
+        return self._operators if entry.is_operator else self._others
+
+    def _tail_index(self, entry):
+        """Display index of an entry that was just appended to its partition."""
+        if entry.is_operator:
+            return len(self._operators) - 1
+        return len(self._entries) - 1
+
+    def add(self, name, flags, ping, stats):
+        """Add a user, or update them in place if they are already present."""
+        entry = self._entries.get(name)
+        if entry is not None:
+            return self.update(name, flags, ping, stats)
+        entry = RosterEntry(name, flags, ping, stats)
+        self._entries[name] = entry
+        self._partition(entry)[name] = entry
+        return UserAdded(name, flags, ping, stats, self._tail_index(entry))
+
+    def update(self, name, flags, ping, stats):
+        """Update an existing user; returns None if the user is unknown."""
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        was_operator = entry.is_operator
+        entry.flags = flags
+        entry.ping = ping
+        entry.stats = stats
+        index = None
+        if entry.is_operator != was_operator:
+            del (self._operators if was_operator else self._others)[name]
+            self._partition(entry)[name] = entry
+            index = self._tail_index(entry)
+        return UserUpdated(name, flags, ping, stats, index)
+
+    def remove(self, name):
+        """Remove a user; returns None if the user is unknown."""
+        entry = self._entries.pop(name, None)
+        if entry is None:
+            return None
+        del self._partition(entry)[name]
+        return UserRemoved(name)
+
+    def snapshot(self):
+        """Deltas that rebuild this roster from nothing: a clear, then every user in display order."""
+        deltas = [RosterCleared()]
+        deltas.extend(UserAdded(entry.name, entry.flags, entry.ping, entry.stats, index)
+                      for index, entry in enumerate(self))
+        return deltas
+
+    def clear(self):
+        self._entries.clear()
+        self._operators.clear()
+        self._others.clear()
+        return RosterCleared()
@@ -0,0 +1,199 @@
+import tempfile
+from array import array
+from collections import deque
+from itertools import islice
+
+
+class LineStore:
+    """Append-only spill file for lines evicted from the in-memory ring.
+
+    Only one offset per line is kept in memory; the text lives on disk until
+    it is paged back in.
+    """
+
+    def __init__(self, path=None):
+        self.file = tempfile.TemporaryFile() if path is None else open(path, "w+b")
+        self.offsets = array("Q")
+        self.size = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append_many(self, lines):
+        offsets = self.offsets
+        pos = self.size
+        chunks = []
+        for line in lines:
+            data = line.encode("utf-8")
+            offsets.append(pos)
+            pos += len(data)
+            chunks.append(data)
+        self.file.seek(self.size)
+        self.file.write(b"".join(chunks))
+        self.size = pos
+
+    def read(self, start, stop):
+        """Return lines [start, stop) from the store."""
+        stop = min(stop, len(self.offsets))
+        if start >= stop:
+            return []
+        offsets = self.offsets
+        base = offsets[start]
+        end = offsets[stop] if stop < len(offsets) else self.size
+        self.file.flush()
+        self.file.seek(base)
+        data = self.file.read(end - base)
+        bounds = [o - base for o in offsets[start:stop]]
+        bounds.append(end - base)
+        return [data[bounds[i]:bounds[i + 1]].decode("utf-8", "replace") for i in range(len(bounds) - 1)]
+
+    def close(self):
+        self.file.close()
+
+
+class Scrollback:
+    """Full session history: a ring of recent lines backed by a LineStore.
+
+    Lines are addressed by their absolute index in the session. When the ring
+    overflows, the oldest quarter is spilled to the store in one write.
+    """
+
+    def __init__(self, capacity=2000, store=None):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.spill_chunk = max(1, capacity // 4)
+        self.recent = deque()
+        self.store = store if store is not None else LineStore()
+
+    def __len__(self):
+        return len(self.store) + len(self.recent)
+
+    def append(self, lines):
+        recent = self.recent
+        recent.extend(lines)
+        if len(recent) > self.capacity + self.spill_chunk:
+            count = len(recent) - self.capacity
+            self.store.append_many([recent.popleft() for _ in range(count)])
+
+    def get(self, start, stop):
+        """Return lines [start, stop) regardless of where they are kept."""
+        stored = len(self.store)
+        stop = min(stop, stored + len(self.recent))
+        lines = []
+        if start < stored:
+            lines = self.store.read(start, min(stop, stored))
+            start = stored
+        if start < stop:
+            lines.extend(islice(self.recent, start - stored, stop - stored))
+        return lines
+
+    def close(self):
+        self.store.close()
+
+
+class ScrollbackView:
+    """Keeps a Text widget showing a bounded window over a Scrollback.
+
+    While following, new lines are appended and the oldest are trimmed in bulk
+    once the window overflows by a page. Scrolling to the top pages older lines
+    back in (dropping the same number from the bottom); scrolling to the bottom
+    pages forward until the view catches up and follows live output again.
+    """
+
+    def __init__(self, text, scrollback, window_lines=2000, scrollbar=None):
+        if window_lines <= 0:
+            raise ValueError("window_lines must be positive")
+        self.text = text
+        self.scrollback = scrollback
+        self.window = window_lines
+        self.page = max(1, window_lines // 4)
+        self.scrollbar = scrollbar
+        self.start = 0
+        self.end = 0
+        self.follow = True
+        self.paging = False
+        text.config(yscrollcommand=self.on_yscroll)
+
+    def append(self, lines):
+        self.scrollback.append(lines)
+        if not self.follow:
+            return
+        text = self.text
+        text.insert("end", "\n".join(lines) + "\n")
+        self.end += len(lines)
+        excess = self.end - self.start - self.window
+        if excess >= self.page:
+            text.delete("1.0", f"{excess + 1}.0")
+            self.start += excess
+        text.see("end")
+
+    def catch_up(self):
+        """Render lines added to the Scrollback directly, e.g. while hidden, in one insert."""
+        total = len(self.scrollback)
+        if self.end >= total and self.follow:
+            return
+        text = self.text
+        if not self.follow or total - self.end >= self.window:
+            # Nothing on screen would survive, so rebuild the window from the tail
+            text.delete("1.0", "end")
+            self.start = self.end = max(0, total - self.window)
+        text.insert("end", "\n".join(self.scrollback.get(self.end, total)) + "\n")
+        self.end = total
+        excess = self.end - self.start - self.window
+        if excess > 0:
+            text.delete("1.0", f"{excess + 1}.0")
+            self.start += excess
+        self.follow = True
+        text.see("end")
+
+    def on_yscroll(self, first, last):
+        if self.scrollbar is not None:
+            self.scrollbar.set(first, last)
+        if self.paging:
+            return
+        if float(first) <= 0.0 and self.start > 0:
+            self.paging = True
+            self.text.after_idle(self.page_back)
+        elif float(last) >= 1.0 and self.end < len(self.scrollback):
+            self.paging = True
+            self.text.after_idle(self.page_forward)
+
+    def page_back(self):
+        """Load the previous page of history above the current window."""
+        self.paging = False
+        count = min(self.page, self.start)
+        if count <= 0:
+            return
+        text = self.text
+        lines = self.scrollback.get(self.start - count, self.start)
+        text.insert("1.0", "\n".join(lines) + "\n")
+        self.start -= count
+        if self.end - self.start > self.window:
+            text.delete(f"{self.window + 1}.0", "end")
+            self.end = self.start + self.window
+        self.follow = False
+        text.yview(f"{count + 1}.0")
+
+    def page_forward(self):
+        """Load the next page of history below the current window."""
+        self.paging = False
+        total = len(self.scrollback)
+        count = min(self.page, total - self.end)
+        if count <= 0:
+            return
+        text = self.text
+        lines = self.scrollback.get(self.end, self.end + count)
+        anchor = self.end - self.start
+        text.insert("end", "\n".join(lines) + "\n")
+        self.end += count
+        excess = self.end - self.start - self.window
+        if excess > 0:
+            text.delete("1.0", f"{excess + 1}.0")
+            self.start += excess
+            anchor -= excess
+        self.follow = self.end >= total
+        if self.follow:
+            text.see("end")
+        else:
+            text.see(f"{max(1, anchor)}.0")
@@ -0,0 +1,193 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import time
+from client import AsyncClient
+from offload import Offloader
+from transport import install_event_loop
+from triggers import TriggerEngine, load_triggers
+
+ACCOUNT_KEYS = ('host', 'port', 'username', 'password', 'home_channel')
+
+
+def load_accounts(config):
+    """Build account definitions from config.
+
+    Entries in config["accounts"] inherit any missing host, port or
+    home_channel from the top level. Without an "accounts" list the top-level
+    account is the only one.
+    """
+    accounts = []
+    for entry in config.get('accounts') or [config]:
+        account = {key: entry.get(key, config.get(key)) for key in ACCOUNT_KEYS}
+        for key in ACCOUNT_KEYS:
+            if account[key] is None:
+                raise KeyError(key)
+        accounts.append(account)
+    return accounts
+
+
+class SessionPool:
+    """Runs many AsyncClient sessions concurrently on one event loop.
+
+    Each session keeps its own connection and reconnect state. Log output from
+    every session goes through one shared dispatch, prefixed with the account
+    name, to the given sinks. Trigger engines are per session, but share one
+    offload pool.
+    """
+
+    def __init__(self, accounts, sinks=(), stagger=0.05, history=None, triggers=(), plugins=(), io_settings=None,
+                 overload_settings=None, offload_settings=None):
+        self.accounts = list(accounts)
+        self.history = history
+        self.triggers = list(triggers)
+        self.plugins = list(plugins)
+        self.io_settings = io_settings
+        self.overload_settings = overload_settings
+        self.offloader = Offloader.from_config(offload_settings)
+        self.sinks = list(sinks)
+        self.stagger = stagger
+        self.clients = {}
+
+    def emit(self, name, message):
+        line = f"[{name}] {message}"
+        for sink in self.sinks:
+            sink.write(line)
+
+    def create_client(self, account, loop):
+        name = account['username']
+        # Every session gets its own engine so cooldowns and replies stay per account
+        engine = load_triggers(TriggerEngine(offloader=self.offloader), self.triggers)
+        return AsyncClient(
+            account['host'], account['port'], name, account['password'], account['home_channel'],
+            lambda msg, name=name: self.emit(name, msg), loop, history=self.history, triggers=engine,
+            plugins=self.plugins, io_settings=self.io_settings, overload_settings=self.overload_settings
+        )
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        tasks = []
+        try:
+            for account in self.accounts:
+                client = self.create_client(account, loop)
+                self.clients[account['username']] = client
+                tasks.append(asyncio.create_task(client.connect()))
+                # Spread logins out so a large pool does not hit the server all at once
+                if self.stagger:
+                    await asyncio.sleep(self.stagger)
+            await asyncio.gather(*tasks)
+        finally:
+            # The sessions' engines share the offload pool but leave closing it to us
+            self.offloader.close()
+            for sink in self.sinks:
+                sink.close()
+
+    def stop(self):
+        for client in self.clients.values():
+            client.stop()
+
+    def status(self):
+        """Per-session connection state, keyed by account name."""
+        return {
+            name: {
+                'connected': client.writer is not None,
+                'state': client.state,
+                'channel': client.message_handler.current_channel,
+                'users': len(client.message_handler.roster),
+                'channels': len(client.message_handler.channels),
+                'reconnects': client.reconnects,
+            }
+            for name, client in self.clients.items()
+        }
+
+
+def aggregate_status(statuses):
+    """Fold per-session status dicts into pool-wide totals."""
+    sessions = connected = users = reconnects = 0
+    for status in statuses:
+        sessions += 1
+        connected += status['connected']
+        users += status['users']
+        reconnects += status['reconnects']
+    return {'sessions': sessions, 'connected': connected, 'users': users, 'reconnects': reconnects}
+
+
+def _run_worker(index, accounts, status_queue, interval, logging_settings, triggers=(), plugins=(), io_settings=None,
+                overload_settings=None, offload_settings=None):
+    """Worker process entry point: run one shard and report its status."""
+    from headless import StdoutSink
+    from log_setup import setup_logging
+
+    # The parent's log listener thread does not survive the fork
+    listener = setup_logging(logging_settings)
+    if io_settings is not None:
+        install_event_loop(io_settings.loop)
+
+    pool = SessionPool(accounts, [StdoutSink()], triggers=triggers, plugins=plugins, io_settings=io_settings,
+                       overload_settings=overload_settings, offload_settings=offload_settings)
+
+    async def report():
+        while True:
+            await asyncio.sleep(interval)
+            status_queue.put((index, pool.status()))
+
+    async def main():
+        reporter = asyncio.create_task(report())
+        try:
+            await pool.run()
+        finally:
+            reporter.cancel()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pool.stop()
+    finally:
+        listener.stop()
+
+
+def run_sharded(accounts, workers=None, interval=5.0, on_status=None, logging_settings=None, triggers=(),
+                plugins=(), io_settings=None, overload_settings=None, offload_settings=None):
+    """Shard accounts across worker processes, each running its own SessionPool.
+
+    on_status is called with (totals, per-session statuses) every time a
+    worker reports; it defaults to printing the totals.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(accounts))
+    if workers < 1:
+        raise ValueError("no accounts to run")
+    status_queue = multiprocessing.Queue()
+    processes = []
+    for index in range(workers):
+        process = multiprocessing.Process(
+            target=_run_worker,
+            args=(index, accounts[index::workers], status_queue, interval, logging_settings, triggers, plugins,
+                  io_settings, overload_settings, offload_settings),
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+
+    shard_status = {}
+    try:
+        while any(process.is_alive() for process in processes):
+            try:
+                index, status = status_queue.get(timeout=interval)
+            except queue.Empty:
+                continue
+            shard_status[index] = status
+            sessions = {}
+            for shard in shard_status.values():
+                sessions.update(shard)
+            totals = aggregate_status(sessions.values())
+            if on_status is not None:
+                on_status(totals, sessions)
+            else:
+                print(f"{time.strftime('%H:%M:%S')} {totals}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
@@ -0,0 +1,184 @@
+"""Soak test: run one client through many reconnects and channel joins, and check it does not leak.
+
+A FakeInit6Server sends every session a channel of users, some chat and a
+join/leave storm. Each cycle the client answers a trigger, runs a /whois
+query and joins another channel, then the server drops the connection and
+the client reconnects on its own. After a warm-up, traced Python memory,
+asyncio task count and RSS are sampled; the run fails (exit status 1) if any
+of them grew past its threshold by the end, or if the client kept more channel
+states than its cap.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import time
+import tracemalloc
+import fake_server
+from client import AsyncClient
+from outbound import TokenBucket
+from triggers import TriggerEngine, load_triggers
+
+
+def rss_bytes():
+    """Resident set size of this process, or None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def sample():
+    gc.collect()
+    traced, _ = tracemalloc.get_traced_memory()
+    return {"traced": traced, "tasks": len(asyncio.all_tasks()), "rss": rss_bytes()}
+
+
+def soak_scenario(users, chat):
+    async def scenario(session):
+        lines = fake_server.join_burst_lines(session.home or "Void", users) + [fake_server.user_in(session.name)]
+        lines += fake_server.chat_lines(chat, users)
+        lines += fake_server.storm_lines(users // 4, 2)
+        lines.append(fake_server.user_talk("user0", "!ping"))
+        await session.send(lines)
+    return scenario
+
+
+async def wait_for(predicate, timeout, interval=0.001):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("soak condition not reached")
+        await asyncio.sleep(interval)
+
+
+def new_client(port):
+    triggers = load_triggers(TriggerEngine(), [{"command": "!ping", "reply": "pong"}])
+    client = AsyncClient("127.0.0.1", port, "soak", "soak", "soak0", lambda msg: None, asyncio.get_running_loop(),
+                         triggers=triggers)
+    # Reconnect at once and never let the rate limit pace the run
+    client.first_delay = client.delay = client.max_delay = 0.001
+    client.outbound.bucket = TokenBucket(10000, 10000)
+    handler = client.message_handler
+    handler.presence.min_window = handler.presence.max_window = 0
+    return client
+
+
+async def cycle(client, server, number, args):
+    """One connection: log in, take the load, answer a trigger and a query, join a channel, get dropped."""
+    handler = client.message_handler
+    await wait_for(lambda: server.logins > number and server.sessions, timeout=30)
+    session = server.sessions[-1]
+    await wait_for(lambda: "pong" in session.commands, timeout=30)
+    await client.query("whois", f"user{number % args.users}", fresh=number % 2 == 0)
+    channel = f"soak{(number + 1) % args.channels}"
+    await client.send_command(f"/join {channel}")
+    await wait_for(lambda: handler.current_channel == channel and handler.batch_task is not None
+                   and handler.batch_task.done(), timeout=30)
+    # Alternate between resuming the channel state and expiring it after the outage
+    client.resume_window = 0 if number % 2 else 60
+    session.close()
+
+
+async def run(args):
+    server = fake_server.FakeInit6Server(scenario=soak_scenario(args.users, args.chat))
+    port = await server.start()
+    tracemalloc.start(args.frames)
+    client = new_client(port)
+    task = asyncio.create_task(client.connect())
+    samples = []
+    baseline = snapshot = None
+    warmup = max(1, args.cycles // 10)
+    started = time.perf_counter()
+    try:
+        for number in range(args.cycles):
+            await cycle(client, server, number, args)
+            if number + 1 == warmup:
+                baseline = sample()
+                snapshot = tracemalloc.take_snapshot()
+                samples.append(dict(baseline, cycle=number + 1))
+            elif number + 1 > warmup and ((number + 1) % args.sample_every == 0 or number + 1 == args.cycles):
+                samples.append(dict(sample(), cycle=number + 1))
+        final = samples[-1]
+        growth = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")[:args.top]
+    finally:
+        client.stop()
+        await server.stop()
+        await asyncio.gather(task, return_exceptions=True)
+        tracemalloc.stop()
+    return {
+        "cycles": args.cycles,
+        "seconds": time.perf_counter() - started,
+        "reconnects": client.reconnects,
+        "channels": len(client.message_handler.channels),
+        "max_channels": client.message_handler.max_channels,
+        "baseline": baseline,
+        "final": final,
+        "samples": samples,
+        "growth": [str(stat) for stat in growth if stat.size_diff > 0],
+    }
+
+
+def check(result, args):
+    """Threshold violations, as messages."""
+    baseline, final = result["baseline"], result["final"]
+    failures = []
+    traced = final["traced"] - baseline["traced"]
+    if traced > args.max_traced_kb * 1024:
+        failures.append(f"traced memory grew {traced / 1024:,.0f} KiB (limit {args.max_traced_kb:,} KiB)")
+    tasks = final["tasks"] - baseline["tasks"]
+    if tasks > args.max_tasks:
+        failures.append(f"task count grew by {tasks} (limit {args.max_tasks})")
+    if result["channels"] > result["max_channels"]:
+        failures.append(f"{result['channels']} channels kept (limit {result['max_channels']})")
+    if baseline["rss"] is not None and final["rss"] is not None:
+        rss = final["rss"] - baseline["rss"]
+        if rss > args.max_rss_mb * 1024 * 1024:
+            failures.append(f"RSS grew {rss / 1024 / 1024:,.1f} MiB (limit {args.max_rss_mb:,} MiB)")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=2000, help="connect/disconnect cycles")
+    parser.add_argument("--users", type=int, default=200, help="channel size sent on every login")
+    parser.add_argument("--chat", type=int, default=200, help="chat lines sent on every login")
+    parser.add_argument("--channels", type=int, default=50,
+                        help="distinct channels to rotate through; more than the handler keeps, so eviction runs")
+    parser.add_argument("--sample-every", type=int, default=100, help="cycles between samples")
+    parser.add_argument("--frames", type=int, default=1, help="traceback depth kept by tracemalloc")
+    parser.add_argument("--top", type=int, default=10, help="allocation sites to list by growth")
+    parser.add_argument("--max-traced-kb", type=int, default=1024, help="allowed traced memory growth")
+    # A reconnect can be mid-flight when a sample is taken, so allow a little slack
+    parser.add_argument("--max-tasks", type=int, default=2, help="allowed growth in live asyncio tasks")
+    parser.add_argument("--max-rss-mb", type=int, default=32, help="allowed RSS growth")
+    parser.add_argument("--json", metavar="PATH", help="also write results as JSON")
+    args = parser.parse_args()
+    if args.cycles < 2:
+        parser.error("--cycles must be at least 2")
+
+    result = asyncio.run(run(args))
+    for point in result["samples"]:
+        rss = f"{point['rss'] / 1024 / 1024:,.1f} MiB" if point["rss"] is not None else "n/a"
+        print(f"cycle {point['cycle']:>6,}  traced={point['traced'] / 1024:,.0f} KiB  "
+              f"tasks={point['tasks']}  rss={rss}")
+    print(f"{result['cycles']:,} cycles, {result['reconnects']:,} reconnects in {result['seconds']:,.1f}s")
+    failures = check(result, args)
+    if failures:
+        print("Largest growth since warm-up:")
+        for line in result["growth"]:
+            print(f"  {line}")
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(dict(result, failures=failures), out, indent=2)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        raise SystemExit(1)
+    print("PASS")
+
+
+if __name__ == "__main__":
+    main()
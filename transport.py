@@ -0,0 +1,232 @@
+import asyncio
+import socket
+from collections import deque
+from log_setup import get_logger
+
+logger = get_logger("transport")
+
+BACKENDS = ("streams", "protocol")
+LOOPS = ("asyncio", "uvloop", "auto")
+
+
+def install_event_loop(kind="asyncio"):
+    """Make new event loops uvloop ones if asked for and installed; returns the loop in use.
+
+    "uvloop" warns and falls back when uvloop is missing, "auto" falls back
+    silently.
+    """
+    if kind not in LOOPS:
+        raise ValueError(f"unknown event loop {kind!r}, expected one of {', '.join(LOOPS)}")
+    if kind == "asyncio":
+        return "asyncio"
+    try:
+        import uvloop
+    except ImportError:
+        if kind == "uvloop":
+            logger.warning("uvloop is not installed; using the default asyncio loop")
+        return "asyncio"
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return "uvloop"
+
+
+class IOSettings:
+    """Connection I/O tuning, from the "io" section of config.json."""
+
+    def __init__(self, backend="streams", loop="asyncio", read_min=1024, read_max=65536, high_water=262144,
+                 nodelay=True, keepalive=True, keepidle=60, keepintvl=10, keepcnt=5, rcvbuf=None, sndbuf=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"unknown io backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+        if loop not in LOOPS:
+            raise ValueError(f"unknown event loop {loop!r}, expected one of {', '.join(LOOPS)}")
+        if not 0 < read_min <= read_max:
+            raise ValueError("need 0 < read_min <= read_max")
+        self.backend = backend
+        self.loop = loop
+        self.read_min = read_min
+        self.read_max = read_max
+        self.high_water = high_water
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.keepidle = keepidle
+        self.keepintvl = keepintvl
+        self.keepcnt = keepcnt
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+
+    @classmethod
+    def from_config(cls, settings):
+        try:
+            return cls(**(settings or {}))
+        except TypeError as e:
+            raise ValueError(f"bad io setting: {e}") from None
+
+    def apply(self, sock):
+        """Set TCP options on a connected socket."""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(self.nodelay)))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(bool(self.keepalive)))
+        if self.keepalive:
+            # Probe timings are Linux/BSD options; skip whichever this platform lacks
+            for name, value in (("TCP_KEEPIDLE", self.keepidle), ("TCP_KEEPINTVL", self.keepintvl),
+                                ("TCP_KEEPCNT", self.keepcnt)):
+                if value is not None and hasattr(socket, name):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+
+
+class ReadSizer:
+    """Read size that follows the traffic: doubles while reads come back full, halves while they stay small."""
+
+    __slots__ = ("size", "minimum", "maximum")
+
+    def __init__(self, minimum=1024, maximum=65536):
+        self.size = minimum
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def update(self, received):
+        if received >= self.size:
+            self.size = min(self.size * 2, self.maximum)
+        elif received < self.size // 4 and self.size > self.minimum:
+            self.size = max(self.size // 2, self.minimum)
+
+
+class StreamSource:
+    """Streams backend: StreamReader reads sized by a ReadSizer."""
+
+    def __init__(self, reader, sizer):
+        self.reader = reader
+        self.sizer = sizer
+
+    async def read(self):
+        data = await self.reader.read(self.sizer.size)
+        self.sizer.update(len(data))
+        return data
+
+
+class ReadProtocol(asyncio.Protocol):
+    """Protocol backend: data_received chunks are queued as-is for a single reader.
+
+    read() hands over everything that arrived since the last call joined into
+    one bytes object, so a burst of small segments is parsed in one go.
+    Reading from the socket pauses once high_water bytes are waiting.
+    """
+
+    def __init__(self, high_water=262144):
+        self.high_water = high_water
+        self.transport = None
+        self.chunks = deque()
+        self.buffered = 0
+        self.receives = 0
+        self.eof = False
+        self.error = None
+        self.reading_paused = False
+        self.waiter = None
+        self.drain_waiter = None
+        self.writing_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.chunks.append(data)
+        self.buffered += len(data)
+        self.receives += 1
+        if self.buffered > self.high_water and not self.reading_paused:
+            self.transport.pause_reading()
+            self.reading_paused = True
+        self.wake()
+
+    def eof_received(self):
+        self.eof = True
+        self.wake()
+        return False
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.error = exc
+        self.wake()
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    def wake(self):
+        waiter = self.waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def read(self):
+        """Everything received since the last read, or b"" once the connection is closed."""
+        while not self.chunks:
+            if self.eof:
+                if self.error is not None:
+                    raise self.error
+                return b""
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        chunks = self.chunks
+        data = chunks.popleft() if len(chunks) == 1 else b"".join(chunks)
+        chunks.clear()
+        self.buffered = 0
+        if self.reading_paused and not self.eof:
+            self.reading_paused = False
+            self.transport.resume_reading()
+        return data
+
+    async def drain(self):
+        if self.transport.is_closing():
+            raise ConnectionResetError("connection lost")
+        if self.writing_paused:
+            self.drain_waiter = asyncio.get_running_loop().create_future()
+            await self.drain_waiter
+
+
+class ProtocolWriter:
+    """The part of StreamWriter the client uses, on top of a ReadProtocol."""
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        await self.protocol.drain()
+
+    def close(self):
+        self.transport.close()
+
+    def is_closing(self):
+        return self.transport.is_closing()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+
+async def open_connection(host, port, settings=None):
+    """Connect using the configured backend; returns (source, writer) where source has async read()."""
+    settings = settings or IOSettings()
+    loop = asyncio.get_running_loop()
+    if settings.backend == "protocol":
+        transport, protocol = await loop.create_connection(lambda: ReadProtocol(settings.high_water), host, port)
+        source, writer = protocol, ProtocolWriter(transport, protocol)
+    else:
+        reader, writer = await asyncio.open_connection(host, port, limit=max(settings.read_max, 65536))
+        source = StreamSource(reader, ReadSizer(settings.read_min, settings.read_max))
+    sock = writer.get_extra_info("socket")
+    if sock is not None:
+        settings.apply(sock)
+    return source, writer
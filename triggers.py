@@ -0,0 +1,399 @@
+import asyncio
+import importlib
+import re
+import time
+from collections import deque
+from functools import partial
+from log_setup import get_logger
+from offload import Offloader, OffloadBusy
+
+logger = get_logger("triggers")
+
+# Regex features that make a pattern unsafe to fold into the prefilter alternation:
+# numbered or named backreferences and conditionals (group numbers shift once
+# patterns are joined) and global inline flags, which must lead the whole regex
+SOLO_REGEX = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|^\(\?[aiLmsux]+\)")
+
+
+class Trigger:
+    """A bot rule: what to match, where, and the coroutine to run."""
+
+    __slots__ = (
+        "name", "kind", "pattern", "handler", "channels", "whispers", "timeout", "cooldown", "offload", "last_fired",
+        "compiled"
+    )
+
+    def __init__(self, kind, pattern, handler, channels=None, whispers=True, timeout=5.0, cooldown=0.0, name=None,
+                 offload=False):
+        if kind not in ("command", "keyword", "regex"):
+            raise ValueError(f"unknown trigger kind {kind!r}")
+        if not callable(handler):
+            raise ValueError("handler must be callable")
+        if offload and asyncio.iscoroutinefunction(handler):
+            raise ValueError("offloaded handlers must be plain functions")
+        self.compiled = None
+        if kind == "regex":
+            try:
+                self.compiled = re.compile(pattern, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"bad trigger regex {pattern!r}: {e}") from None
+        self.name = name or f"{kind}:{pattern}"
+        self.kind = kind
+        self.pattern = pattern
+        self.handler = handler
+        self.channels = frozenset(c.lower() for c in channels) if channels else None
+        self.whispers = whispers
+        self.timeout = timeout
+        self.cooldown = cooldown
+        # Offloaded handlers are called as handler(user, channel, args, text) in
+        # the offload pool and return the reply text, or None for no reply
+        self.offload = offload
+        # Last fire time per channel (None for whispers)
+        self.last_fired = {}
+
+
+class TriggerContext:
+    """What a handler gets: the message, the match, and a way to reply."""
+
+    __slots__ = ("engine", "trigger", "channel", "user", "text", "whisper", "args", "match")
+
+    def __init__(self, engine, trigger, channel, user, text, whisper, args="", match=None):
+        self.engine = engine
+        self.trigger = trigger
+        self.channel = channel
+        self.user = user
+        self.text = text
+        self.whisper = whisper
+        self.args = args
+        self.match = match
+
+    async def reply(self, text):
+        """Answer where the message came from: whisper back, or say it in channel."""
+        if self.whisper:
+            await self.engine.send(f"/w {self.user} {text}")
+        else:
+            await self.engine.send(text)
+
+
+class CommandTrie:
+    """Character trie of command words; lookup cost depends only on the command length."""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, command, value):
+        node = self.root
+        for char in command:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(value)
+
+    def match(self, text):
+        """Longest command that text starts with, ending at a space or end of text.
+
+        Returns (values, rest of text) or (None, text).
+        """
+        node = self.root
+        best = None
+        best_end = 0
+        for index, char in enumerate(text):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node and (index + 1 == len(text) or text[index + 1] == " "):
+                best = node[None]
+                best_end = index + 1
+        if best is None:
+            return None, text
+        return best, text[best_end:].strip()
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over all keywords; one pass over the text finds them all."""
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+    def add(self, word, value):
+        state = 0
+        for char in word:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        self.output[state].append((len(word), value))
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def search(self, text):
+        """Yield values whose keyword occurs in text as a whole word."""
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, value in output[state]:
+                start = index - length + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (index + 1 == len(text) or not text[index + 1].isalnum()):
+                    yield value
+
+
+class CompiledRules:
+    """All triggers for one scope, compiled into three matchers.
+
+    Regex triggers are joined into one alternation that only serves as a
+    prefilter: when it finds nothing, none of them can match, and when it
+    does, each pattern is run on its own so every matching trigger fires
+    with its own groups. Patterns that cannot be joined safely are always
+    run on their own.
+    """
+
+    def __init__(self, triggers):
+        self.commands = CommandTrie()
+        self.keywords = KeywordMatcher()
+        self.prefilter = None
+        self.filtered = []
+        self.solo = []
+        for trigger in triggers:
+            if trigger.kind == "command":
+                self.commands.add(trigger.pattern.lower(), trigger)
+            elif trigger.kind == "keyword":
+                self.keywords.add(trigger.pattern.lower(), trigger)
+            elif SOLO_REGEX.search(trigger.pattern):
+                self.solo.append(trigger)
+            else:
+                self.filtered.append(trigger)
+        self.keywords.build()
+        if self.filtered:
+            try:
+                self.prefilter = re.compile("|".join(f"(?:{t.pattern})" for t in self.filtered), re.IGNORECASE)
+            except re.error as e:
+                logger.warning("Regex triggers cannot share a prefilter (%s); matching them one by one", e)
+                self.solo.extend(self.filtered)
+                self.filtered = []
+
+    def match(self, text):
+        """Yield (trigger, args, match) for every rule text satisfies."""
+        lowered = text.lower()
+        commands, args = self.commands.match(lowered)
+        if commands:
+            # Hand the arguments over with their original case
+            args = text[len(text) - len(args):] if args else ""
+            for trigger in commands:
+                yield trigger, args, None
+        seen = set()
+        for trigger in self.keywords.search(lowered):
+            if trigger not in seen:
+                seen.add(trigger)
+                yield trigger, text, None
+        if self.prefilter is not None and self.prefilter.search(text):
+            for trigger in self.filtered:
+                match = trigger.compiled.search(text)
+                if match is not None:
+                    yield trigger, text, match
+        for trigger in self.solo:
+            match = trigger.compiled.search(text)
+            if match is not None:
+                yield trigger, text, match
+
+
+class TriggerEngine:
+    """Matches chat and whispers against compiled triggers and runs their handlers.
+
+    Triggers are grouped by channel scope (plus one global scope) and each
+    scope is compiled once into a command trie, an Aho-Corasick keyword
+    automaton and a single alternation regex prefilter, so a message that
+    fires nothing costs the same whether there are five rules or five
+    hundred. Handlers run as
+    tasks with a per-trigger timeout and cooldown; CPU-heavy ones marked
+    offload=True run in the offloader's pool so they never hold up the loop.
+    An offloader passed in may be shared with other engines, so close()
+    leaves it to its creator and only shuts down one the engine made itself.
+    """
+
+    def __init__(self, send=None, ignore=(), offloader=None):
+        self.send = send
+        self.offloader = offloader
+        self.owns_offloader = False
+        self.ignore = {name.lower() for name in ignore}
+        self.triggers = []
+        self.scopes = None
+        self.tasks = set()
+        self.fired = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    def add(self, trigger):
+        self.triggers.append(trigger)
+        self.scopes = None
+        return trigger
+
+    def _decorator(self, kind, pattern, **options):
+        def register(handler):
+            self.add(Trigger(kind, pattern, handler, **options))
+            return handler
+        return register
+
+    def command(self, name, **options):
+        """Decorator registering a prefix command such as "!help"."""
+        return self._decorator("command", name, **options)
+
+    def keyword(self, word, **options):
+        """Decorator registering a whole-word, case-insensitive keyword."""
+        return self._decorator("keyword", word, **options)
+
+    def regex(self, pattern, **options):
+        """Decorator registering a case-insensitive regular expression."""
+        return self._decorator("regex", pattern, **options)
+
+    def compile(self):
+        scoped = {None: []}
+        for trigger in self.triggers:
+            for channel in trigger.channels or (None,):
+                scoped.setdefault(channel, []).append(trigger)
+        self.scopes = {channel: CompiledRules(triggers) for channel, triggers in scoped.items()}
+
+    def match(self, channel, text):
+        if self.scopes is None:
+            self.compile()
+        yield from self.scopes[None].match(text)
+        rules = self.scopes.get(channel.lower()) if channel else None
+        if rules is not None:
+            yield from rules.match(text)
+
+    def dispatch(self, channel, user, text, whisper=False):
+        """Start handlers for every trigger the message fires; returns how many started."""
+        if not self.triggers or user.lower() in self.ignore:
+            return 0
+        now = time.monotonic()
+        started = 0
+        for trigger, args, match in self.match(None if whisper else channel, text):
+            if whisper and not trigger.whispers:
+                continue
+            if trigger.offload:
+                if self.offloader is None:
+                    self.offloader = Offloader()
+                    self.owns_offloader = True
+                if self.offloader.saturated:
+                    # Shed work rather than queue it when the pool is backed up
+                    self.rejected += 1
+                    self.offloader.rejected.inc()
+                    continue
+            key = None if whisper else channel
+            if trigger.cooldown and now - trigger.last_fired.get(key, -trigger.cooldown) < trigger.cooldown:
+                continue
+            trigger.last_fired[key] = now
+            context = TriggerContext(self, trigger, channel, user, text, whisper, args, match)
+            task = asyncio.create_task(self.run(trigger, context))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            started += 1
+        self.fired += started
+        return started
+
+    async def run(self, trigger, context):
+        try:
+            if trigger.offload:
+                reply = await asyncio.wait_for(self.offloader.run_nowait(
+                    trigger.handler, context.user, context.channel, context.args, context.text
+                ), trigger.timeout)
+                if reply:
+                    await context.reply(reply)
+            else:
+                await asyncio.wait_for(trigger.handler(context), trigger.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning("Trigger %s timed out after %ss", trigger.name, trigger.timeout)
+        except OffloadBusy:
+            self.rejected += 1
+            logger.warning("Trigger %s dropped, offload queue full", trigger.name)
+        except Exception:
+            logger.exception("Trigger %s failed", trigger.name)
+
+    def cancel_all(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+    def close(self):
+        self.cancel_all()
+        if self.owns_offloader:
+            self.offloader.close()
+
+
+def format_reply(template, user, channel, args, text):
+    """template.format(user=, channel=, args=, text=); module-level so a process pool can run it."""
+    return template.format(user=user, channel=channel or "", args=args, text=text)
+
+
+def reply_handler(template):
+    """Handler that answers with template.format(user=, channel=, args=, text=)."""
+    async def handler(context):
+        await context.reply(format_reply(template, context.user, context.channel, context.args, context.text))
+    return handler
+
+
+def import_handler(path):
+    """The function a dotted "package.module.function" path names."""
+    module_name, _, name = path.rpartition(".")
+    if not module_name:
+        raise ValueError(f"trigger handler must be a dotted module path: {path!r}")
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as e:
+        raise ValueError(f"cannot import trigger handler {path!r}: {e}") from None
+    handler = getattr(module, name, None)
+    if not callable(handler):
+        raise ValueError(f"trigger handler {path!r} is not a function")
+    return handler
+
+
+def load_triggers(engine, entries):
+    """Add triggers from config, e.g. {"command": "!ping", "reply": "pong {user}"}.
+
+    Instead of a reply an entry can name a "handler", a plain function given
+    as a dotted path; it runs in the engine's offload pool as
+    function(user, channel, args, text) and returns the reply text. "offload":
+    true sends a reply template through the pool as well.
+    """
+    for entry in entries:
+        for kind in ("command", "keyword", "regex"):
+            if kind in entry:
+                pattern = entry[kind]
+                break
+        else:
+            raise ValueError(f"trigger needs a command, keyword or regex: {entry!r}")
+        if "handler" in entry:
+            handler, offload = import_handler(entry["handler"]), True
+        elif "reply" in entry:
+            offload = bool(entry.get("offload", False))
+            handler = partial(format_reply, entry["reply"]) if offload else reply_handler(entry["reply"])
+        else:
+            raise ValueError(f"trigger needs a reply or a handler: {entry!r}")
+        engine.add(Trigger(
+            kind, pattern, handler,
+            channels=entry.get("channels"),
+            whispers=entry.get("whispers", True),
+            timeout=entry.get("timeout", 5.0),
+            cooldown=entry.get("cooldown", 0.0),
+            offload=offload,
+        ))
+    return engine
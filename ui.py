@@ -1,10 +1,142 @@
 #ui.py
+import time
 import tkinter as tk
 from tkinter import ttk
 from PIL import Image, ImageTk
+from history import parse_query
+from log_setup import get_logger
+from scrollback import Scrollback, ScrollbackView
+from roster import OPERATOR_FLAGS
+from userlist import UserIndex, UserListView
+
+# Pixel height of a user list row; icons are 16 high
+ROW_HEIGHT = 20
+
+logger = get_logger("ui")
+
+class ChannelView:
+    """One notebook tab: a channel's log and user list.
+
+    Only the selected tab renders. The others append log lines straight to
+    their Scrollback and apply roster deltas only to their UserIndex; showing
+    the tab then draws both in one pass instead of touching hidden widgets
+    per event.
+    """
+
+    def __init__(self, ui, notebook, name, channel, scrollback_lines):
+        self.ui = ui
+        self.channel = channel
+        self.topic = ""
+        self.visible = False
+
+        self.frame = tk.Frame(notebook, bg="#1C2526")
+        notebook.add(self.frame, text=name)
+
+        # Frame for Text widget
+        text_frame = tk.Frame(self.frame, bg="#1C2526")
+        text_frame.pack(side="left", pady=5, fill="both", expand=True)
+
+        self.output_text = tk.Text(
+            text_frame,
+            height=15,
+            font=("Courier", 11),
+            bg="#0F1419",
+            fg="#E0E0E0",
+            insertbackground="#FFFFFF",
+            padx=5,
+            pady=5,
+            bd=1,
+            relief="solid",
+            wrap="word"
+        )
+        self.output_text.pack(side="left", fill="both", expand=True)
+
+        text_scrollbar = ttk.Scrollbar(text_frame, orient="vertical", command=self.output_text.yview)
+        text_scrollbar.pack(side="right", fill="y")
+
+        # Bounded view over the channel's history; older lines page in on scroll
+        self.scrollback = ScrollbackView(
+            self.output_text,
+            Scrollback(capacity=scrollback_lines),
+            window_lines=scrollback_lines,
+            scrollbar=text_scrollbar
+        )
+
+        # Frame for User List
+        user_frame = tk.Frame(self.frame, bg="#1C2526", width=220)
+        user_frame.pack(side="right", fill="y", padx=(5, 0))
+        user_frame.pack_propagate(False)
+
+        # Narrows the list to names containing what is typed, names starting with it first
+        self.filter_entry = tk.Entry(
+            user_frame,
+            font=("Courier", 10),
+            bg="#2E2E2E",
+            fg="#FFFFFF",
+            insertbackground="#FFFFFF",
+            bd=1,
+            relief="solid"
+        )
+        self.filter_entry.pack(side="top", fill="x", pady=(0, 5))
+        self.filter_entry.bind("<KeyRelease>", lambda event: self.on_filter())
+
+        self.user_tree = ttk.Treeview(
+            user_frame,
+            columns=("Username",),
+            show="tree",
+            selectmode="browse",
+            height=15,
+            style="Custom.Treeview"
+        )
+        self.user_tree.pack(side="left", fill="both", expand=True)
+
+        # Configure columns
+        self.user_tree.column("#0", width=50, stretch=False)  # Icon column
+        self.user_tree.column("Username", width=150, stretch=True)
+
+        # The tree only holds the rows on screen, so the list scrolls through the index instead
+        user_scrollbar = ttk.Scrollbar(user_frame, orient="vertical")
+        user_scrollbar.pack(side="right", fill="y")
+        self.users = UserIndex()
+        self.user_list = UserListView(
+            self.user_tree,
+            self.users,
+            ui.user_icon,
+            scrollbar=user_scrollbar,
+            row_height=ROW_HEIGHT,
+            on_pick=ui.on_user_select
+        )
+
+    def log(self, lines):
+        if self.visible:
+            self.scrollback.append(lines)
+        else:
+            self.scrollback.scrollback.append(lines)
+
+    def apply(self, deltas):
+        self.users.apply(deltas)
+        if self.visible:
+            self.user_list.refresh()
+
+    def on_filter(self):
+        if self.users.set_filter(self.filter_entry.get()):
+            self.user_list.scroll_to(0)
+
+    def show(self):
+        self.visible = True
+        self.user_list.refresh()
+        self.scrollback.catch_up()
+
+    def hide(self):
+        self.visible = False
+
+    def close(self):
+        self.scrollback.scrollback.close()
+        self.frame.destroy()
+
 
 class BotUI:
-    def __init__(self, root, client):
+    def __init__(self, root, client, scrollback_lines=2000, history=None):
         self.root = root
         self.root.title(f"{client.uname} | {client.host}")
         
@@ -19,13 +151,15 @@ class BotUI:
 
         # Load icons for oper, tahc, and px2d
         self.icons = {}
+        # (flags, stats) -> icon, filled in as users with new combinations show up
+        self.icon_cache = {}
         icon_keys = ["OPER", "TAHC", "PX2D", "RTSJ"]
         for key in icon_keys:
             path = f"icons/{key}.png"
             try:
                 self.icons[key] = ImageTk.PhotoImage(Image.open(path).resize((32, 16)))
             except FileNotFoundError:
-                print(f"Icon file '{path}' not found; using no icon for {key}")
+                logger.warning("Icon file '%s' not found; using no icon for %s", path, key)
                 self.icons[key] = None
 
         # Top frame for channel/topic labels
@@ -55,37 +189,34 @@ class BotUI:
         )
         self.topic_label.pack(side="left", padx=10)
 
-        # Main frame to hold text and user list
-        main_frame = tk.Frame(self.root, bg="#1C2526")
-        main_frame.pack(pady=5, fill="both", expand=True)
-
-        # Frame for Text widget
-        text_frame = tk.Frame(main_frame, bg="#1C2526")
-        text_frame.pack(side="left", pady=5, fill="both", expand=True)
-
-        self.output_text = tk.Text(
-            text_frame, 
-            height=15, 
-            font=("Courier", 11), 
-            bg="#0F1419", 
-            fg="#E0E0E0", 
-            insertbackground="#FFFFFF", 
-            padx=5,
-            pady=5,
-            bd=1, 
-            relief="solid",
-            wrap="word"
-        )
-        self.output_text.pack(side="left", fill="both", expand=True)
-
-        text_scrollbar = ttk.Scrollbar(text_frame, orient="vertical", command=self.output_text.yview)
-        text_scrollbar.pack(side="right", fill="y")
-        self.output_text.config(yscrollcommand=text_scrollbar.set)
-
-        # Frame for User List
-        user_frame = tk.Frame(main_frame, bg="#1C2526", width=220)
-        user_frame.pack(side="right", fill="y", padx=(5, 0))
-        user_frame.pack_propagate(False)
+        # History search box, only when a history store is configured
+        self.history = history
+        if history is not None:
+            search_frame = tk.Frame(top_frame, bg="#1C2526")
+            search_frame.pack(side="right", padx=5, before=label_frame)
+            self.search_entry = tk.Entry(
+                search_frame,
+                font=("Courier", 10),
+                bg="#2E2E2E",
+                fg="#FFFFFF",
+                insertbackground="#FFFFFF",
+                bd=1,
+                relief="solid",
+                width=30
+            )
+            self.search_entry.pack(side="left")
+            self.search_entry.bind("<Return>", lambda event: self.search_history())
+            tk.Button(
+                search_frame,
+                text="Search",
+                command=self.search_history,
+                font=("Courier", 10),
+                bg="#2E2E2E",
+                fg="#FFFFFF",
+                activebackground="#3C3C3C",
+                bd=1,
+                relief="solid"
+            ).pack(side="left", padx=(5, 0))
 
         style = ttk.Style()
         style.configure(
@@ -93,29 +224,20 @@ class BotUI:
             background="#0F1419",
             foreground="#E0E0E0",
             fieldbackground="#0F1419",
-            font=("Courier", 11)
-        )
-
-        self.user_tree = ttk.Treeview(
-            user_frame,
-            columns=("Username",),
-            show="tree",
-            selectmode="browse",
-            height=15,
-            style="Custom.Treeview"
+            font=("Courier", 11),
+            rowheight=ROW_HEIGHT
         )
-        self.user_tree.pack(side="left", fill="both", expand=True)
-        
-        # Configure columns
-        self.user_tree.column("#0", width=50, stretch=False)  # Icon column
-        self.user_tree.column("Username", width=150, stretch=True)
-
-        user_scrollbar = ttk.Scrollbar(user_frame, orient="vertical", command=self.user_tree.yview)
-        user_scrollbar.pack(side="right", fill="y")
-        self.user_tree.config(yscrollcommand=user_scrollbar.set)
 
-        # Bind selection event
-        self.user_tree.bind("<<TreeviewSelect>>", self.on_user_select)
+        # One tab per channel; the first collects server lines from before any join
+        self.scrollback_lines = scrollback_lines
+        self.notebook = ttk.Notebook(self.root)
+        self.notebook.pack(pady=5, fill="both", expand=True)
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        self.notebook.bind("<Button-2>", self.on_tab_middle_click)
+        self.views = {}
+        self.live = self.add_view(client.host, "")
+        self.selected = None
+        self.select_view(self.live)
 
         # Frame for Entry and Send button (inline)
         input_frame = tk.Frame(self.root, bg="#1C2526")
@@ -153,81 +275,140 @@ class BotUI:
 
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
+    def add_view(self, name, channel):
+        view = ChannelView(self, self.notebook, name, channel, self.scrollback_lines)
+        self.views[channel.lower()] = view
+        return view
+
+    def select_view(self, view):
+        self.notebook.select(view.frame)
+
+    def on_tab_changed(self, event):
+        """Show the chosen tab, rendering whatever it buffered while hidden in one pass."""
+        frame = self.notebook.nametowidget(self.notebook.select())
+        view = next((view for view in self.views.values() if view.frame is frame), None)
+        if view is None:
+            return
+        if self.selected is not None:
+            self.selected.hide()
+        self.selected = view
+        view.show()
+        self.channel_label.config(text=f"Channel: {self.selected.channel}" if self.selected.channel else "")
+        self.topic_label.config(text=f"|  Topic: {self.selected.topic}" if self.selected.topic else "")
+
+    def on_tab_middle_click(self, event):
+        """Close a tab, except the one for the channel the session is in."""
+        try:
+            index = self.notebook.index(f"@{event.x},{event.y}")
+        except tk.TclError:
+            return
+        frame = self.notebook.nametowidget(self.notebook.tabs()[index])
+        for key, view in self.views.items():
+            if view.frame is frame and view is not self.live and view.channel:
+                del self.views[key]
+                if view is self.selected:
+                    self.selected = None
+                    self.select_view(self.live)
+                view.close()
+                return
+
     def log(self, message):
-        if message.startswith("CHANNEL_JOIN "):
-            channel = message[len("CHANNEL_JOIN "):].strip()
-            self.channel_label.config(text=f"Channel: {channel}")
-            self.topic_label.config(text="")
-            self.log(f"Joined {channel}")
-        elif message.startswith("CHANNEL_TOPIC "):
-            topic = message[len("CHANNEL_TOPIC "):].strip()
-            self.topic_label.config(text=f"|  Topic: {topic}")
+        self.log_batch((message,))
+
+    def log_batch(self, messages):
+        """Write several log messages to the live channel's view with a single insert."""
+        lines = []
+        for message in messages:
+            if message.startswith("CHANNEL_JOIN "):
+                if lines:
+                    self.live.log(lines)
+                    lines = []
+                channel = message[len("CHANNEL_JOIN "):].strip()
+                view = self.views.get(channel.lower())
+                if view is None:
+                    view = self.add_view(channel, channel)
+                self.live = view
+                self.select_view(view)
+                lines.append(f"Joined {channel}")
+            elif message.startswith("CHANNEL_TOPIC "):
+                self.live.topic = message[len("CHANNEL_TOPIC "):].strip()
+                if self.live is self.selected:
+                    self.topic_label.config(text=f"|  Topic: {self.live.topic}")
+            else:
+                lines.append(message)
+        if lines:
+            self.live.log(lines)
+
+    def user_icon(self, flags, stats):
+        key = (flags, stats)
+        if key in self.icon_cache:
+            return self.icon_cache[key]
+        if flags == OPERATOR_FLAGS:
+            icon = self.icons.get("OPER")
         else:
-            self.output_text.insert(tk.END, message + "\n")
-            self.output_text.see(tk.END)
-
-    def update_user_list(self, users, is_leave=False, leaving_user=None):
-        """Update the user list atomically, with operators at top and non-operators below, both in server order."""        
-        # Handle leave event
-        if is_leave and leaving_user:
-            for item in self.user_tree.get_children():
-                if self.user_tree.item(item, "values")[0] == leaving_user:
-                    self.user_tree.delete(item)
-                    break
+            icon = self.icons.get(stats, self.icons.get("TAHC"))
+        self.icon_cache[key] = icon
+        return icon
+
+    def update_user_list(self, deltas):
+        """Apply roster deltas to the live channel's user list."""
+        self.live.apply(deltas)
+
+    def on_user_select(self, username):
+        """Handle a user being picked in the selected tab's user list."""
+        view = self.selected
+        if view is not None and username in view.users.roster:
+            view.output_text.see(tk.END)
+
+    def search_history(self):
+        """Query the history store, e.g. "user:bob channel:dark since:2d keyword"."""
+        query = self.search_entry.get().strip()
+        if not query:
+            return
+        try:
+            criteria = parse_query(query)
+        except ValueError as e:
+            self.log(f"Search error: {e}")
             return
+        start = time.perf_counter()
+        rows = self.history.search(**criteria)
+        elapsed = time.perf_counter() - start
+        self.show_search_results(query, rows, elapsed)
 
-        # Build a map of new users
-        new_users = {user.name: user for user in users}
-        current_items = self.user_tree.get_children()
-        current_users = {self.user_tree.item(item, "values")[0]: item for item in current_items}
-
-        # Remove users no longer in the list
-        for username, item in current_users.items():
-            if username not in new_users:
-                self.user_tree.delete(item)
-
-        # Separate operators and non-operators, preserving server order
-        operators = [user for user in users if user.flags == "18"]
-        non_operators = [user for user in users if user.flags != "18"]
-
-        # Combine lists: operators first, then non-operators, no sorting
-        ordered_users = operators + non_operators
-
-        # Add or update users in the combined order
-        for index, user in enumerate(ordered_users):
-            icon = self.icons.get("OPER") if user.flags == "18" else self.icons.get(user.stats, self.icons.get("TAHC"))
-            if user.name not in current_users:
-                # Insert new user at the specified index
-                self.user_tree.insert(
-                    "", index, text="",
-                    image=icon,
-                    values=(user.name,)
-                )
-            else:
-                # Update icon and values for existing user
-                self.user_tree.item(
-                    current_users[user.name],
-                    image=icon,
-                    values=(user.name,)
-                )
-                # Move existing user to the correct position
-                self.user_tree.move(current_users[user.name], "", index)
-
-    def on_user_select(self, event):
-        """Handle user selection in the Treeview."""
-        selected_items = self.user_tree.selection()
-        if selected_items:
-            selected_username = self.user_tree.item(selected_items[0], "values")[0]
-            for user in self.client.message_handler.channel_users:
-                if user.name == selected_username:
-                    self.output_text.see(tk.END)
-                    break
+    def show_search_results(self, query, rows, elapsed):
+        window = tk.Toplevel(self.root)
+        window.title(f"History: {query}")
+        window.geometry("800x500")
+        window.configure(bg="#1C2526")
+        results = tk.Text(
+            window,
+            font=("Courier", 10),
+            bg="#0F1419",
+            fg="#E0E0E0",
+            padx=5,
+            pady=5,
+            bd=1,
+            relief="solid",
+            wrap="word"
+        )
+        results.pack(side="left", fill="both", expand=True)
+        scrollbar = ttk.Scrollbar(window, orient="vertical", command=results.yview)
+        scrollbar.pack(side="right", fill="y")
+        results.config(yscrollcommand=scrollbar.set)
+
+        lines = [f"{len(rows)} results in {elapsed * 1000:.1f} ms"]
+        for ts, channel, user, kind, text in rows:
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+            speaker = f"{user}: " if user else ""
+            lines.append(f"{stamp} [{channel or '-'}] {speaker}{text}")
+        results.insert("1.0", "\n".join(lines))
+        results.config(state="disabled")
 
     def check_running(self):
         if self.client.running:
             self.root.after(100, self.check_running)
         else:
-            print("BotUI: Connection stopped")
+            logger.info("Connection stopped")
             self.send_button.config(state="disabled")
             self.channel_label.config(text="")
             self.topic_label.config(text="")
@@ -235,11 +416,13 @@ class BotUI:
     def send_message(self):
         command = self.input_entry.get().strip()
         if command:
-            print(f"BotUI: Sending message: {command}")
+            logger.debug("Sending message: %s", command)
             self.client.send(command)
             self.input_entry.delete(0, tk.END)
 
     def on_closing(self):
-        print("BotUI: Closing window")
+        logger.info("Closing window")
         self.client.stop()
+        for view in self.views.values():
+            view.scrollback.scrollback.close()
         self.root.destroy()
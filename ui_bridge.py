@@ -0,0 +1,140 @@
+import time
+from collections import deque
+from metrics import registry
+from roster import RosterCleared
+
+LOG_EVENT = 0
+ROSTER_EVENT = 1
+
+
+class UIBridge:
+    """Hands events from the asyncio thread to the Tk mainloop.
+
+    Producers only append to a deque (append and popleft are atomic in CPython,
+    so no lock is taken) and never touch a widget. The Tk side drains the queue
+    from root.after at a fixed frame rate, writing all pending log lines with a
+    single insert and applying all pending roster deltas in one pass. A
+    CHANNEL_JOIN line starts a new batch, since everything after it belongs
+    to another channel's view.
+
+    At most max_queued events wait at once, so a stalled Tk thread cannot
+    grow the queue without bound. Past that, log lines are dropped (except
+    CHANNEL_JOIN) and counted. Roster deltas are dropped too, but then
+    resync() is called once the queue has room again, so the client can
+    post a fresh snapshot of the roster.
+    """
+
+    def __init__(self, root, ui, fps=30, max_events=5000, max_queued=20000, resync=None):
+        if fps <= 0:
+            raise ValueError("fps must be positive")
+        if max_queued < 1:
+            raise ValueError("max_queued must be at least 1")
+        self.root = root
+        self.ui = ui
+        self.interval = max(1, int(1000 / fps))
+        self.max_events = max_events
+        self.max_queued = max_queued
+        self.resync = resync
+        self.resync_pending = False
+        self.queue = deque()
+        self.running = False
+        self.after_id = None
+
+        # Drain statistics
+        self.last_drain_latency = 0.0
+        self.max_drain_latency = 0.0
+        self.last_drain_count = 0
+        self.drain_lag = registry.histogram("ui_drain_lag_seconds")
+        self.dropped = registry.counter("ui_dropped")
+        registry.gauge("ui_queue_depth", lambda: len(self.queue))
+
+    def post_log(self, message):
+        """Queue a log line; safe to call from any thread."""
+        if len(self.queue) >= self.max_queued and not message.startswith("CHANNEL_JOIN "):
+            self.dropped.inc()
+            return
+        self.queue.append((LOG_EVENT, message, time.monotonic()))
+
+    def post_roster(self, deltas):
+        """Queue a list of roster deltas; safe to call from any thread."""
+        if len(self.queue) >= self.max_queued:
+            self.dropped.inc(len(deltas))
+            self.resync_pending = True
+            return
+        self.queue.append((ROSTER_EVENT, deltas, time.monotonic()))
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def stats(self):
+        return {
+            "depth": len(self.queue),
+            "last_drain_latency": self.last_drain_latency,
+            "max_drain_latency": self.max_drain_latency,
+            "last_drain_count": self.last_drain_count,
+        }
+
+    def start(self):
+        self.running = True
+        self.after_id = self.root.after(self.interval, self.drain)
+
+    def stop(self):
+        self.running = False
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+
+    def drain(self):
+        """Apply up to max_events queued events to the UI, then reschedule."""
+        self.after_id = None
+        queue = self.queue
+        count = min(len(queue), self.max_events)
+        if count:
+            latency = time.monotonic() - queue[0][2]
+            lines = []
+            deltas = []
+            for _ in range(count):
+                kind, payload, _ = queue.popleft()
+                if kind == LOG_EVENT:
+                    if payload.startswith("CHANNEL_JOIN ") and (lines or deltas):
+                        self.apply(lines, deltas)
+                        lines = []
+                        deltas = []
+                    lines.append(payload)
+                else:
+                    deltas.extend(payload)
+            self.apply(lines, deltas)
+
+            self.last_drain_count = count
+            self.last_drain_latency = latency
+            self.drain_lag.observe(latency)
+            if latency > self.max_drain_latency:
+                self.max_drain_latency = latency
+
+        if self.resync_pending and len(queue) < self.max_queued and self.resync is not None:
+            # Roster deltas were dropped; ask for the whole roster again now there is room
+            self.resync_pending = False
+            self.resync()
+
+        if self.running:
+            # Come back almost immediately if a backlog is left, but still yield to Tk
+            delay = 1 if queue else self.interval
+            self.after_id = self.root.after(delay, self.drain)
+
+    def apply(self, lines, deltas):
+        """Hand one channel's worth of drained events to the UI."""
+        if deltas:
+            # Anything before the last clear is already obsolete
+            for i in range(len(deltas) - 1, -1, -1):
+                if deltas[i].__class__ is RosterCleared:
+                    del deltas[:i]
+                    break
+        if lines and lines[0].startswith("CHANNEL_JOIN "):
+            # Switch views before the roster deltas that follow the join are applied
+            self.ui.log_batch(lines[:1])
+            del lines[:1]
+        if deltas:
+            self.ui.update_user_list(deltas)
+        if lines:
+            self.ui.log_batch(lines)
@@ -0,0 +1,188 @@
+from bisect import bisect_left, insort
+from roster import Roster, UserAdded, UserUpdated, UserRemoved, RosterCleared
+
+# Sorts after any character a name can contain, for prefix range ends
+NAME_MAX = "\U0010ffff"
+
+
+class UserIndex:
+    """The user list's own copy of a channel roster, with a sorted name index.
+
+    Deltas are applied to a private Roster, so the unfiltered list comes out
+    in display order (operators first, then server order) without sorting.
+    (lowercased name, name) pairs are also kept sorted: a filter finds the
+    names starting with it by bisection and lists them first, followed by
+    the names that merely contain it. Typing more of the same filter only
+    rescans the previous matches.
+    """
+
+    # Batches bigger than this rebuild the sorted index instead of patching it
+    bulk = 256
+
+    def __init__(self):
+        self.roster = Roster()
+        self.keys = []
+        self.query = ""
+        self.matches = None
+        self.cache = None
+
+    def __len__(self):
+        return len(self.rows())
+
+    def apply(self, deltas):
+        roster = self.roster
+        keys = self.keys
+        if keys is not None and len(deltas) > self.bulk:
+            keys = self.keys = None
+        for delta in deltas:
+            kind = delta.__class__
+            if kind is UserAdded:
+                if keys is not None and delta.name not in roster:
+                    insort(keys, (delta.name.lower(), delta.name))
+                roster.add(delta.name, delta.flags, delta.ping, delta.stats)
+            elif kind is UserUpdated:
+                roster.update(delta.name, delta.flags, delta.ping, delta.stats)
+            elif kind is UserRemoved:
+                if roster.remove(delta.name) is not None and keys is not None:
+                    del keys[bisect_left(keys, (delta.name.lower(), delta.name))]
+            elif kind is RosterCleared:
+                roster.clear()
+                # Stay unsorted if this batch is big enough to sort once at the end
+                keys = self.keys = [] if keys is not None else None
+        self.matches = None
+        self.cache = None
+
+    def sorted_keys(self):
+        if self.keys is None:
+            self.keys = sorted((name.lower(), name) for name in self.roster.names())
+        return self.keys
+
+    def set_filter(self, text):
+        """Filter by a case-insensitive name fragment; returns whether the rows changed."""
+        query = text.strip().lower()
+        if query == self.query:
+            return False
+        if not (self.query and self.query in query):
+            self.matches = None
+        self.query = query
+        self.cache = None
+        return True
+
+    def rows(self):
+        """RosterEntries to show, in order."""
+        if self.cache is not None:
+            return self.cache
+        roster = self.roster
+        query = self.query
+        if not query:
+            self.cache = list(roster)
+            return self.cache
+        keys = self.sorted_keys()
+        start = bisect_left(keys, (query,))
+        stop = bisect_left(keys, (query + NAME_MAX,), start)
+        candidates = keys if self.matches is None else self.matches
+        self.matches = [key for key in candidates if query in key[0]]
+        rows = [roster.get(name) for _, name in keys[start:stop]]
+        rows.extend(roster.get(name) for low, name in self.matches if not low.startswith(query))
+        self.cache = rows
+        return rows
+
+
+class UserListView:
+    """Shows a UserIndex in a Treeview holding only the rows on screen.
+
+    The Treeview gets one item per visible line. Scrolling and roster changes
+    rewrite those items from the index instead of inserting and deleting an
+    item per user, so drawing costs the same for ten users or ten thousand.
+    The selection is tracked by name, since items are reused for other rows.
+    """
+
+    def __init__(self, tree, index, icon, scrollbar=None, row_height=20, lines=15, on_pick=None):
+        self.tree = tree
+        self.index = index
+        self.icon = icon
+        self.scrollbar = scrollbar
+        self.row_height = row_height
+        self.on_pick = on_pick
+        self.items = []
+        self.top = 0
+        self.selected = None
+        if scrollbar is not None:
+            scrollbar.config(command=self.on_scroll)
+        tree.bind("<Configure>", self.on_resize)
+        tree.bind("<MouseWheel>", self.on_wheel)
+        tree.bind("<Button-4>", self.on_wheel)
+        tree.bind("<Button-5>", self.on_wheel)
+        tree.bind("<<TreeviewSelect>>", self.on_select)
+        self.resize(lines)
+
+    def resize(self, lines):
+        lines = max(1, lines)
+        tree = self.tree
+        while len(self.items) < lines:
+            self.items.append(tree.insert("", "end", text="", values=("",)))
+        if len(self.items) > lines:
+            tree.delete(*self.items[lines:])
+            del self.items[lines:]
+
+    def refresh(self):
+        """Redraw the visible window from the index."""
+        rows = self.index.rows()
+        count = len(rows)
+        lines = len(self.items)
+        self.top = max(0, min(self.top, count - lines))
+        tree = self.tree
+        icon = self.icon
+        chosen = None
+        for offset, item in enumerate(self.items):
+            position = self.top + offset
+            if position < count:
+                entry = rows[position]
+                tree.item(item, image=icon(entry.flags, entry.stats) or "", values=(entry.name,))
+                if entry.name == self.selected:
+                    chosen = item
+            else:
+                tree.item(item, image="", values=("",))
+        # Move the highlight with the selected user; on_select ignores the event this causes
+        wanted = (chosen,) if chosen is not None else ()
+        if tuple(tree.selection()) != wanted:
+            tree.selection_set(wanted)
+        if self.scrollbar is not None:
+            if count:
+                self.scrollbar.set(self.top / count, min(1.0, (self.top + lines) / count))
+            else:
+                self.scrollbar.set(0.0, 1.0)
+
+    def scroll_to(self, top):
+        self.top = top
+        self.refresh()
+
+    def on_scroll(self, action, value, unit=None):
+        """Scrollbar command: ("moveto", fraction) or ("scroll", count, "units" | "pages")."""
+        if action == "moveto":
+            self.scroll_to(int(float(value) * len(self.index.rows())))
+        elif action == "scroll":
+            step = len(self.items) if unit == "pages" else 1
+            self.scroll_to(self.top + int(value) * step)
+
+    def on_wheel(self, event):
+        up = event.num == 4 or getattr(event, "delta", 0) > 0
+        self.scroll_to(self.top + (-3 if up else 3))
+        return "break"
+
+    def on_resize(self, event):
+        lines = max(1, event.height // self.row_height)
+        if lines != len(self.items):
+            self.resize(lines)
+            self.refresh()
+
+    def on_select(self, event):
+        selection = self.tree.selection()
+        if not selection or selection[0] not in self.items:
+            return
+        position = self.top + self.items.index(selection[0])
+        rows = self.index.rows()
+        if position < len(rows) and rows[position].name != self.selected:
+            self.selected = rows[position].name
+            if self.on_pick is not None:
+                self.on_pick(self.selected)